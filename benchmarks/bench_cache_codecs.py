@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Compares load/save time and file size of the cache codecs on a synthetic cache.
+#
+# Usage: python benchmarks/bench_cache_codecs.py [--entries 50000]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import oe1_get  # noqa: E402
+
+WORDS = ('Ö1', 'Radiogeschichten', 'Hörspiel', 'Journal', 'Musik', 'Wissenschaft', 'Gespräch', 'über', 'die',
+    'der', 'und', 'mit', 'Interview', 'Reportage', 'Klassik', 'Jazz', 'Literatur', 'Geschichte', 'Europa')
+
+
+def synthetic_cache(entries, seed=1):
+    """Returns broadcast data shaped like the audioapi detail JSON"""
+    rnd = random.Random(seed)
+
+    def text(n):
+        return ' '.join(rnd.choice(WORDS) for _ in range(n))
+
+    start = int(time.time() - 7 * 86400) * 1000
+    cache = {}
+    for i in range(entries):
+        href = 'https://audioapi.orf.at/oe1/api/json/current/broadcast/{}/2021{:04d}'.format(600000 + i, i % 1000)
+        cache[href] = {
+            'id': 600000 + i,
+            'href': href,
+            'title': text(3),
+            'subtitle': '<p>{}</p>'.format(text(12)),
+            'description': '<p>{}</p><p><a href="https://oe1.orf.at">{}</a></p>'.format(text(60), text(4)),
+            'pressRelease': '',
+            'akm': '<p>{}</p>'.format(text(20)),
+            'tags': [rnd.choice(WORDS) for _ in range(3)],
+            'scheduledStart': start + i * 60000,
+            'duration': rnd.randint(5, 120) * 60000,
+            'url': 'https://oe1.orf.at/programm/2021{:04d}/{}'.format(i % 1000, 600000 + i),
+            'streams': [{'loopStreamId': '2021-01-01_{:04d}_tl_54_7DaysMon9_{}.mp3'.format(i % 2400, i)}],
+        }
+    return cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the cache codecs on a synthetic cache')
+    parser.add_argument('--entries', type=int, default=50000, help='number of cache entries (default: %(default)s)')
+    args = parser.parse_args()
+
+    data = synthetic_cache(args.entries)
+    print('{} entries'.format(len(data)))
+    print('{:<14} {:>9} {:>9} {:>12}'.format('codec', 'save [s]', 'load [s]', 'size [kB]'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for codec, (_, _, extension) in oe1_get.CACHE_CODECS.items():
+            missing_module = oe1_get.cache_codec_missing(codec)
+            if missing_module:
+                print('{:<14} not available, {} is not installed'.format(codec, missing_module))
+                continue
+            cache_fn = os.path.join(tmp_dir, oe1_get.CACHE_BASE_FN + extension)
+            cache = oe1_get.FileCache(cache_fn, codec)
+            cache.update(data)
+            t0 = time.perf_counter()
+            cache.save()
+            t1 = time.perf_counter()
+            loaded = oe1_get.FileCache(cache_fn, codec)
+            loaded.load()
+            t2 = time.perf_counter()
+            assert loaded == data
+            print('{:<14} {:>9.3f} {:>9.3f} {:>12.0f}'.format(codec, t1 - t0, t2 - t1, os.path.getsize(cache_fn) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+# Runs oe1_get.py against a local stand-in for the audioapi and loopstream servers and reports the wall
+# time, CPU time and throughput of every stage (schedule, detail fetch, match, download, encode, tag).
+#
+# The server serves a synthetic schedule (or a recorded one, see --recorded) and generated audio, with
+# configurable latency, bandwidth and injected errors. Without --ffmpeg a stand-in which doesn't decode
+# anything is used, so the encode stage then only measures the process and pipe overhead.
+#
+# Usage: python benchmarks/bench_offline.py [--interesting 14] [--latency 50] [--bandwidth 20] [--runs 2]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import functools
+import threading
+import subprocess
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+TITLES = ('Morgenjournal', 'Pasticcio', 'Punkt eins', 'Dimensionen', 'Mittagsjournal', 'Von Tag zu Tag',
+    'Im Gespräch', 'Zeit-Ton', 'Jazznacht', 'Diagonal', 'Leporello', 'Ambiente', 'Nachrichten')
+
+DESCRIPTION = ('<p>Eine <b>Sendung</b> mit <a href="https://oe1.orf.at/">Links</a> und '
+    '<i>Hervorhebungen</i>.</p><ul><li>Punkt eins</li><li>Punkt zwei</li></ul>') * 4
+
+INI = """[Benchmark]
+TimeWindow = 00:00 - 24:00
+title = ^Benchmark
+TargetDir = {DOWNLOAD_BASEDIR}/{SECTION}
+"""
+
+# writes a minimal Ogg Opus file as output, reads the whole input and reports progress like ffmpeg
+FFMPEG_STAND_IN = r'''
+import sys, struct
+args = sys.argv[1:]
+source = args[args.index('-i') + 1]
+data = sys.stdin.buffer.read() if source == 'pipe:0' else open(source, 'rb').read()
+if '-progress' in args:
+    print('out_time_us={}\nprogress=end'.format(len(data) // 16), flush=True)
+
+def page(sequence, packet, position, flags):
+    header = b'OggS' + struct.pack('<BBqIIIB', 0, flags, position, 1, sequence, 0, 1) + bytes([len(packet)])
+    checksum = 0
+    for byte in header + packet:
+        checksum = ((checksum << 8) ^ CRC[((checksum >> 24) ^ byte) & 0xff]) & 0xffffffff
+    return header[:22] + struct.pack('<I', checksum) + header[26:] + packet
+
+CRC = []
+for i in range(256):
+    r = i << 24
+    for _ in range(8):
+        r = ((r << 1) ^ 0x04c11db7 if r & 0x80000000 else r << 1) & 0xffffffff
+    CRC.append(r)
+with open(args[-1], 'wb') as fout:
+    fout.write(page(0, b'OpusHead' + struct.pack('<BBHIhB', 1, 1, 312, 48000, 0, 0), 0, 2))
+    fout.write(page(1, b'OpusTags' + struct.pack('<I', 5) + b'bench' + struct.pack('<I', 0), 0, 0))
+    fout.write(page(2, b'\xf8\xff\xfe', 960, 4))
+'''
+
+
+def synthetic_schedule(base_url, interesting, per_day=48, seed=1):
+    """Seven days up to now with per_day broadcasts each, interesting of them titled "Benchmark"
+
+    Returns the schedule and the details by broadcast id."""
+    rnd = random.Random(seed)
+    end = int(time.time()) // 1800 * 1800
+    slot = 86400 // per_day
+    starts = [end - (7 * per_day - i) * slot for i in range(7 * per_day)]
+    benchmark_slots = set(rnd.sample(range(len(starts)), min(interesting, len(starts))))
+    days = collections.OrderedDict()
+    details = {}
+    for i, start in enumerate(starts):
+        broadcast_id = 100000 + i
+        title = 'Benchmark {}'.format(i) if i in benchmark_slots else rnd.choice(TITLES)
+        entry = {
+            'id': broadcast_id,
+            'title': title,
+            'scheduledStart': start * 1000,
+            'scheduledEnd': (start + slot) * 1000,
+            'href': '{}/broadcasts/{}'.format(base_url, broadcast_id),
+        }
+        days.setdefault(time.strftime('%Y%m%d', time.localtime(start)), []).append(entry)
+        details[broadcast_id] = dict(entry,
+            subtitle='<p>Untertitel {}</p>'.format(i),
+            description=DESCRIPTION,
+            pressRelease=DESCRIPTION if i % 2 else '',
+            akm='',
+            tags=['Benchmark', 'Ö1'],
+            url='https://oe1.orf.at/',
+            duration=slot * 1000,
+            streams=[{'loopStreamId': '2026-01-01_{}_bench.mp3'.format(broadcast_id)}])
+    return [{'day': day, 'broadcasts': broadcasts} for day, broadcasts in days.items()], details
+
+
+def recorded_schedule(base_url, recorded_dir):
+    """A schedule recorded from the audioapi: current.json and broadcasts/<id>.json, hrefs point to the server"""
+    with open(os.path.join(recorded_dir, 'current.json'), encoding='utf-8') as fin:
+        schedule = json.load(fin)
+    details = {}
+    for day in schedule:
+        for entry in day['broadcasts']:
+            detail_fn = os.path.join(recorded_dir, 'broadcasts', '{}.json'.format(entry['id']))
+            if os.path.isfile(detail_fn):
+                with open(detail_fn, encoding='utf-8') as fin:
+                    details[entry['id']] = json.load(fin)
+            entry['href'] = '{}/broadcasts/{}'.format(base_url, entry['id'])
+    return schedule, details
+
+
+def generate_audio(ffmpeg, seconds):
+    """An MP3 of the given length made by ffmpeg, or random bytes of the same size (128 kbit/s)"""
+    if ffmpeg is None:
+        return os.urandom(seconds * 16000)
+    result = subprocess.run([ffmpeg, '-v', 'error', '-f', 'lavfi',
+        '-i', 'sine=frequency=440:duration={}'.format(seconds), '-c:a', 'libmp3lame', '-b:a', '128k',
+        '-f', 'mp3', 'pipe:1'], stdout=subprocess.PIPE, check=True)
+    return result.stdout
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.options = options
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.schedule = []
+        self.details = {}
+        self.audio = b''
+        self.rnd = random.Random(2)
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    def inject_error(self, rate):
+        with self.lock:
+            return self.rnd.random() < rate
+
+    def handle_error(self, request, client_address):
+        """Counts the connections the client closed early, e.g. after a dropped response, instead of printing
+        their tracebacks"""
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            with self.lock:
+                self.requests['reset'] += 1
+            return
+        super().handle_error(request, client_address)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, code, body, content_type='application/json', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.write_throttled(body)
+
+    def write_throttled(self, body):
+        """Writes the body limited to the --bandwidth of the server, per connection"""
+        bandwidth = self.server.options.bandwidth * 1024 * 1024
+        chunk_size = 64 * 1024
+        drop_at = len(body) // 2 if len(body) > chunk_size and self.server.inject_error(
+            self.server.options.drop_rate) else None
+        t0 = time.perf_counter()
+        for offset in range(0, len(body), chunk_size):
+            if drop_at is not None and offset >= drop_at:
+                self.close_connection = True
+                return
+            self.wfile.write(body[offset:offset + chunk_size])
+            if bandwidth:
+                delay = t0 + (offset + chunk_size) / bandwidth - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        server.requests[url.path.split('/')[1]] += 1
+        time.sleep(server.options.latency / 1000)
+        if url.path == '/current':
+            body = json.dumps(server.schedule).encode('utf-8')
+            etag = '"{}"'.format(len(body))
+            if self.headers.get('If-None-Match') == etag:
+                return self.send_body(304, b'')
+            return self.send_body(200, body, headers={'ETag': etag})
+        if server.inject_error(server.options.error_rate):
+            return self.send_body(503, b'{"message": "Service Unavailable"}')
+        if url.path.startswith('/broadcasts/'):
+            data = server.details.get(int(url.path.split('/')[-1]))
+            if data is None:
+                return self.send_body(404, b'{"message": "Not Found"}')
+            return self.send_body(200, json.dumps(data).encode('utf-8'))
+        if url.path == '/loop' and parse_qs(url.query).get('id'):
+            return self.send_audio()
+        self.send_body(404, b'{"message": "Not Found"}')
+
+    def send_audio(self):
+        audio = self.server.audio
+        headers = {'Accept-Ranges': 'bytes'}
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return self.send_body(200, audio, 'audio/mpeg', headers)
+        first, last = range_header.split('=', 1)[1].split('-')
+        first = int(first)
+        last = min(int(last), len(audio) - 1) if last else len(audio) - 1
+        if first >= len(audio):
+            headers['Content-Range'] = 'bytes */{}'.format(len(audio))
+            return self.send_body(416, b'', 'audio/mpeg', headers)
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, len(audio))
+        self.send_body(206, audio[first:last + 1], 'audio/mpeg', headers)
+
+
+class StageTimer:
+    """Wall and thread CPU time of the calls of wrapped functions, by stage"""
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, stage, started, wall, cpu, size):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes': 0,
+                'first': started, 'last': started + wall})
+            totals['calls'] += 1
+            totals['wall'] += wall
+            totals['cpu'] += cpu
+            totals['bytes'] += size
+            totals['first'] = min(totals['first'], started)
+            totals['last'] = max(totals['last'], started + wall)
+
+    def wrap(self, stage, func, size_of=None):
+        """Returns func timed as stage, size_of(args) returns the bytes processed by a call"""
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            c0 = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, t0, time.perf_counter() - t0, time.thread_time() - c0,
+                    size_of(args) if size_of else 0)
+        return timed
+
+    def report(self):
+        print('{:<16} {:>6} {:>10} {:>10} {:>10} {:>9} {:>9}'.format(
+            'stage', 'calls', 'wall sum', 'span', 'thread CPU', 'MB', 'MB/s'))
+        for stage, totals in self.stages.items():
+            span = totals['last'] - totals['first']
+            megabytes = totals['bytes'] / 1024 / 1024
+            print('{:<16} {:>6} {:>9.3f}s {:>9.3f}s {:>9.3f}s {:>9.1f} {:>9}'.format(
+                stage, totals['calls'], totals['wall'], span, totals['cpu'], megabytes,
+                '{:.1f}'.format(megabytes / span) if megabytes and span else '-'))
+
+
+def file_size(fn):
+    return os.path.getsize(fn) if os.path.isfile(fn) else 0
+
+
+def count_chunks(func, sizes):
+    """Wraps encode_stream to record the size of the streamed chunks by conversion file name"""
+    @functools.wraps(func)
+    def counted(chunks, conv_fn, *args, **kwargs):
+        def counting():
+            for chunk in chunks:
+                sizes[conv_fn] = sizes.get(conv_fn, 0) + len(chunk)
+                yield chunk
+        return func(counting(), conv_fn, *args, **kwargs)
+    return counted
+
+
+def instrument(oe1_get, timer):
+    """Wraps the functions of every stage, the originals are looked up as module globals at call time"""
+    downloader = oe1_get.BroadcastsDownloader
+    downloader._load_schedule = timer.wrap('schedule', downloader._load_schedule)
+    downloader._fetch_broadcast_data = timer.wrap('detail fetch', downloader._fetch_broadcast_data)
+    downloader._match_schedule = timer.wrap('match', downloader._match_schedule)
+    oe1_get.download_file = timer.wrap('download', oe1_get.download_file, lambda args: file_size(args[2]))
+    oe1_get.encode_audiofile = timer.wrap('encode', oe1_get.encode_audiofile, lambda args: file_size(args[0]))
+    streamed = {}
+    oe1_get.encode_stream = timer.wrap('download+encode', count_chunks(oe1_get.encode_stream, streamed),
+        lambda args: streamed.pop(args[1], 0))
+    oe1_get.tag_media_file = timer.wrap('tag', oe1_get.tag_media_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark oe1_get.py against a local stand-in server')
+    parser.add_argument('--interesting', type=int, default=14,
+        help='broadcasts of interest in the synthetic schedule (default: %(default)s)')
+    parser.add_argument('--recorded', metavar='DIR',
+        help='serve a recorded schedule: DIR/current.json and DIR/broadcasts/<id>.json')
+    parser.add_argument('--ini', help='ini file to use (default: one section matching the synthetic broadcasts)')
+    parser.add_argument('--audio-seconds', type=int, default=60,
+        help='length of the served audio (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=20, help='latency per request in ms (default: %(default)s)')
+    parser.add_argument('--bandwidth', type=float, default=0,
+        help='bandwidth per connection in MB/s, 0 for unlimited (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='fraction of detail and audio requests answered with 503 (default: %(default)s)')
+    parser.add_argument('--drop-rate', type=float, default=0,
+        help='fraction of audio responses cut off halfway (default: %(default)s)')
+    parser.add_argument('--ffmpeg', help='a real ffmpeg executable (default: a stand-in which does not decode)')
+    parser.add_argument('--runs', type=int, default=1,
+        help='runs in the same directory, the later ones measure the cached paths (default: %(default)s)')
+    parser.add_argument('--keep', action='store_true', help='keep the download directory')
+    parser.add_argument('options', nargs=argparse.REMAINDER,
+        help='further oe1_get.py options after "--", e.g. -- --engine async --stream-encode')
+    args = parser.parse_args()
+
+    server = StandInServer(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if args.recorded:
+        server.schedule, server.details = recorded_schedule(server.base_url, args.recorded)
+    else:
+        server.schedule, server.details = synthetic_schedule(server.base_url, args.interesting)
+    server.audio = generate_audio(args.ffmpeg, args.audio_seconds)
+
+    # the URLs are read when oe1_get is imported
+    os.environ['OE1_CURRENT_URL'] = server.base_url + '/current'
+    os.environ['OE1_DOWNLOAD_BASE_URL'] = server.base_url + '/loop?id='
+    sys.path.insert(0, ROOT)
+    import oe1_get  # noqa: E402
+
+    download_basedir = tempfile.mkdtemp(prefix='oe1_bench_')
+    ffmpeg = args.ffmpeg
+    if ffmpeg is None:
+        ffmpeg = os.path.join(download_basedir, 'ffmpeg')
+        with open(ffmpeg, 'w') as fout:
+            fout.write('#!{}\n{}'.format(sys.executable, FFMPEG_STAND_IN))
+        os.chmod(ffmpeg, 0o755)
+    ini_fn = args.ini
+    if ini_fn is None:
+        ini_fn = os.path.join(download_basedir, 'bench.ini')
+        with open(ini_fn, 'w', encoding='utf-8') as fout:
+            fout.write(INI)
+
+    option_parser = argparse.ArgumentParser(add_help=False)
+    option_parser.add_argument('--engine', default='sync')
+    option_parser.add_argument('--stream-encode', action='store_true')
+    option_parser.add_argument('--download-segments', type=int, default=1)
+    option_parser.add_argument('--download-jobs', type=int, default=oe1_get.DOWNLOAD_JOBS)
+    option_parser.add_argument('--encode-jobs', type=int, default=None)
+    option_parser.add_argument('--fetch-workers', type=int, default=oe1_get.FETCH_WORKERS)
+    option_parser.add_argument('--cache-backend', default='file')
+    option_parser.add_argument('--cache-codec', default='json+bz2')
+    options = vars(option_parser.parse_args([option for option in args.options if option != '--']))
+
+    print('{} broadcasts, {} details, {:.1f} MB audio, server {}'.format(
+        sum(len(day['broadcasts']) for day in server.schedule), len(server.details),
+        len(server.audio) / 1024 / 1024, server.base_url))
+    try:
+        for run in range(1, args.runs + 1):
+            timer = StageTimer()
+            originals = dict(vars(oe1_get)), dict(vars(oe1_get.BroadcastsDownloader))
+            instrument(oe1_get, timer)
+            server.requests.clear()
+            children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_before = time.process_time()
+            t0 = time.perf_counter()
+            try:
+                downloader = oe1_get.BroadcastsDownloader(download_basedir, ini_fn, ffmpeg=ffmpeg, **options)
+                try:
+                    downloader.download_interesting()
+                finally:
+                    downloader.close()
+            finally:
+                for name in ('download_file', 'encode_audiofile', 'encode_stream', 'tag_media_file'):
+                    setattr(oe1_get, name, originals[0][name])
+                for name in ('_load_schedule', '_fetch_broadcast_data', '_match_schedule'):
+                    setattr(oe1_get.BroadcastsDownloader, name, originals[1][name])
+            wall = time.perf_counter() - t0
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            print('\nRun {}: {:.3f} s wall, {:.3f} s CPU in the process, {:.3f} s CPU in child processes, '
+                'requests: {}'.format(run, wall, time.process_time() - cpu_before,
+                children.ru_utime + children.ru_stime - children_before.ru_utime - children_before.ru_stime,
+                ', '.join('{} {}'.format(path, count) for path, count in sorted(server.requests.items()))))
+            timer.report()
+    finally:
+        server.shutdown()
+        if args.keep:
+            print('Kept {}'.format(download_basedir))
+        else:
+            shutil.rmtree(download_basedir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Compares the ways of matching the schedule against the ini sections on a synthetic schedule:
+# the original loop over all sections per broadcast, the rule index and the NumPy schedule table.
+#
+# Usage: python benchmarks/bench_schedule_filter.py [--weeks 52] [--sections 200]
+
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import oe1_get  # noqa: E402
+
+TITLES = ('Morgenjournal', 'Pasticcio', 'Radiogeschichten', 'Punkt eins', 'Dimensionen', 'Hörspiel-Galerie',
+    'Mittagsjournal', 'Von Tag zu Tag', 'Im Gespräch', 'Zeit-Ton', 'Jazznacht', 'Diagonal', 'Intrada',
+    'Leporello', 'Ambiente', 'Contra', 'Moment', 'Salzburger Nachtstudio', 'Opernabend', 'Nachrichten')
+
+
+def synthetic_schedule(weeks, seed=1):
+    """About 700 broadcasts per week, like the Ö1 schedule"""
+    rnd = random.Random(seed)
+    start = int(time.time()) // 86400 * 86400 - weeks * 7 * 86400
+    broadcasts = []
+    for day in range(weeks * 7):
+        minute = 0
+        while minute < 24 * 60:
+            title = rnd.choice(TITLES)
+            broadcasts.append({
+                'title': '{} {}'.format(title, rnd.randint(1, 20)) if rnd.random() < 0.2 else title,
+                'scheduledStart': (start + day * 86400 + minute * 60) * 1000,
+            })
+            minute += rnd.choice((5, 5, 15, 30, 55, 60))
+    return broadcasts
+
+
+def synthetic_rules(sections, seed=1):
+    rnd = random.Random(seed)
+    rules = {}
+    for i in range(sections):
+        start = rnd.randint(0, 23 * 60)
+        end = min(start + rnd.choice((30, 60, 120, 360)), 24 * 60)
+        rules['Section {}'.format(i)] = oe1_get.section_rule({
+            'Days': ','.join(map(str, sorted(rnd.sample(range(7), rnd.randint(1, 7))))),
+            'TimeWindow': '{:02d}:{:02d}-{:02d}:{:02d}'.format(start // 60, start % 60, end // 60, end % 60),
+            'title': rnd.choice(TITLES).split(' ')[0] + rnd.choice(('', '.*', '$')),
+        })
+    return rules
+
+
+def match_loop(broadcasts, rules):
+    """The original per broadcast loop over all sections"""
+    sections = []
+    for broadcast in broadcasts:
+        dt = datetime.datetime.fromtimestamp(int(broadcast['scheduledStart']) // 1000)
+        seconds = dt.hour * 3600 + dt.minute * 60 + dt.second
+        for section, rule in rules.items():
+            if (rule['start_seconds'] <= seconds <= rule['end_seconds']
+                    and dt.weekday() in rule['days']
+                    and rule['search_regexes']['title'].search(broadcast['title'])):
+                sections.append(section)
+                break
+        else:
+            sections.append('')
+    return sections
+
+
+def match_rule_index(broadcasts, rules):
+    rule_index = oe1_get.RuleIndex(rules)
+    sections = []
+    for broadcast in broadcasts:
+        dt = datetime.datetime.fromtimestamp(int(broadcast['scheduledStart']) // 1000)
+        sections.append(rule_index.match(dt.weekday(), dt.hour * 3600 + dt.minute * 60 + dt.second,
+            broadcast['title']))
+    return sections
+
+
+def match_schedule_table(broadcasts, rules):
+    return oe1_get.ScheduleTable(broadcasts).match(rules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the schedule matching implementations')
+    parser.add_argument('--weeks', type=int, default=52, help='weeks of schedule data (default: %(default)s)')
+    parser.add_argument('--sections', type=int, default=200, help='number of ini sections (default: %(default)s)')
+    args = parser.parse_args()
+
+    broadcasts = synthetic_schedule(args.weeks)
+    rules = synthetic_rules(args.sections)
+    print('{} broadcasts, {} sections'.format(len(broadcasts), len(rules)))
+    implementations = [('per broadcast loop', match_loop), ('rule index', match_rule_index)]
+    if oe1_get.optional_import('numpy') is not None:
+        implementations.append(('schedule table', match_schedule_table))
+    else:
+        print('schedule table: not available, numpy is not installed')
+    expected = None
+    for name, implementation in implementations:
+        t0 = time.perf_counter()
+        sections = implementation(broadcasts, rules)
+        elapsed = time.perf_counter() - t0
+        if expected is None:
+            expected = sections
+        assert sections == expected, name
+        print('{:<20} {:>8.3f} s  {:>6} matches'.format(name, elapsed, sum(1 for section in sections if section)))
+
+
+if __name__ == '__main__':
+    main()
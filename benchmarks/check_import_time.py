@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Checks that the cheap command line paths of oe1_get.py don't import the network, tagging and progress
+# bar modules, using the output of "python -X importtime". Exits with 1 on a regression.
+#
+# Usage: python benchmarks/check_import_time.py [--max-ms 150]
+
+import os
+import re
+import bz2
+import sys
+import json
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'oe1_get.py')
+
+# modules which must only be imported by the code paths using them
+HEAVY_MODULES = ('requests', 'mutagen', 'html2text', 'tqdm', 'asyncio', 'numpy')
+
+INI = """[Radiogeschichten]
+TimeWindow = 10:00 - 11:00
+title = Radiogeschichten
+"""
+
+
+def cache_entry(number):
+    """Returns the data of a broadcast number days ago in the section of INI"""
+    scheduled_start = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=number),
+        datetime.time(10, 30))
+    return {'id': number, 'title': 'Radiogeschichten', 'scheduledStart': int(scheduled_start.timestamp() * 1000),
+        'streams': [{'loopStreamId': '{}.mp3'.format(number)}]}
+
+
+def write_cache(tmp_dir):
+    """Writes a small snapshot of the default file cache and a journal for --list-cached"""
+    cache_fn = os.path.join(tmp_dir, 'oe1cache.json.bz2')
+    with open(cache_fn, 'wb') as fout:
+        fout.write(bz2.compress(json.dumps({
+            'https://example.invalid/broadcast/{}'.format(number): cache_entry(number)
+            for number in range(1, 4)}).encode('utf-8')))
+    with open(cache_fn + '.journal', 'wb') as fout:
+        fout.write(json.dumps({'href': 'https://example.invalid/broadcast/0', 'data': cache_entry(0)})
+            .encode('utf-8') + b'\n')
+
+
+def import_times(args):
+    """Runs python with -X importtime, returns its exit status, the cumulative import times in microseconds
+    of the top level imports by module and the names of all imported modules"""
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    modules = set()
+    for line in result.stderr.splitlines():
+        m = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)$', line)
+        if m:
+            modules.add(m.group(3))
+            if len(m.group(2)) == 1:
+                times[m.group(3)] = int(m.group(1))
+    return result.returncode, times, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the imports of the cheap oe1_get.py command line paths')
+    parser.add_argument('--max-ms', type=float, default=150,
+        help='maximum import time of the script\'s modules (default: %(default)s ms)')
+    args = parser.parse_args()
+
+    _, baseline, _ = import_times(['-c', 'pass'])
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ini_fn = os.path.join(tmp_dir, 'check.ini')
+        with open(ini_fn, 'w', encoding='utf-8') as fout:
+            fout.write(INI)
+        write_cache(tmp_dir)
+        for name, script_args in (
+                ('--help', ['--help']),
+                ('--check-config', [tmp_dir, ini_fn, '--check-config']),
+                ('--list-cached', [tmp_dir, ini_fn, '--list-cached'])):
+            returncode, times, modules = import_times([SCRIPT] + script_args)
+            heavy = [module for module in HEAVY_MODULES if module in modules]
+            # the modules imported by the interpreter itself are not the script's
+            total_ms = sum(us for module, us in times.items() if module not in baseline) / 1000
+            print('{:<16} {:>8.1f} ms  heavy imports: {}{}'.format(name, total_ms, ', '.join(heavy) or 'none',
+                '' if returncode == 0 else '  exit status: {}'.format(returncode)))
+            # a path which stops early doesn't show its imports
+            if heavy or total_ms > args.max_ms or returncode != 0:
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,29 +9,111 @@
 import os
 import sys
 import json
+import operator
 import re
 import bz2
+import bisect
+import sqlite3
 import argparse
+import collections
+import collections.abc
 import configparser
+import contextlib
 import datetime
+import functools
+import hashlib
+import importlib
+import io
 import shutil
+import signal
+import string
 import subprocess
+import threading
+import queue
+import time
+import urllib.parse
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-import mutagen
-import html2text
-from tqdm import tqdm
+
+class LazyImport:
+    """A module, or an attribute of a module, which is imported when it is used for the first time
+
+    Keeps the heavy imports out of the paths which don't need them, like --help or --check-config."""
+
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+asyncio = LazyImport('asyncio')
+requests = LazyImport('requests')
+mutagen = LazyImport('mutagen')
+html2text = LazyImport('html2text')
+tqdm = LazyImport('tqdm', 'tqdm')
+cProfile = LazyImport('cProfile')
+pstats = LazyImport('pstats')
+tracemalloc = LazyImport('tracemalloc')
 
 __version__ = '2021-12-23.0'
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-HTML_CACHE_FN = 'oe1cache.json.bz2'
+CACHE_BASE_FN = 'oe1cache'
+HTML_CACHE_FN = CACHE_BASE_FN + '.json.bz2'
+SQLITE_CACHE_FN = 'oe1cache.sqlite'
+SCHEDULE_CACHE_FN = 'oe1schedule.json'
+STATE_DB_FN = 'oe1state.sqlite'
+PROFILE_FN = 'oe1profile-{}'
+JOURNAL_SUFFIX = '.journal'
+TEXT_CACHE_SUFFIX = '.html2text'
+# below this, the rule index is faster than setting up the NumPy columns
+SCHEDULE_TABLE_MIN_BROADCASTS = 2000
+JOURNAL_MAX_ENTRIES = 200
+# the cache is only compacted once this fraction of its entries has been evicted, entries expire all the time
+CACHE_COMPACT_FRACTION = 0.25
+# broadcasts are available for 7 days, older cache entries are never used again
+CACHE_MAX_AGE = 14 * 86400
 FFMPEG_EXECUTABLE = 'ffmpeg'
+FETCH_WORKERS = 8
+DOWNLOAD_JOBS = 2
+TAG_JOBS = 1
+# the jobs waiting in front of each stage of the pipeline, e.g. downloaded files waiting to be encoded
+PIPELINE_QUEUE_SIZE = 2
+DOWNLOAD_TIMEOUT = 3
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+# the daemon wakes up this long after a broadcast of interest has ended, the loopstream needs a moment
+DAEMON_END_DELAY = 120
+# while ended broadcasts are not available, the daemon retries after this delay, doubled every time
+DAEMON_RETRY_DELAY = 60
+# broadcasts which are still not available this long after their end are given up
+DAEMON_RETRY_WINDOW = 86400
+DAEMON_MAX_SLEEP = 3600
+# the number of allocation sites in the tracemalloc report of a phase
+TRACEMALLOC_TOP = 30
+PART_SUFFIX = '.part'
+# how often a running ffmpeg checks whether it has to stop
+FFMPEG_POLL_INTERVAL = 0.1
+# the loopstream serves MP3, the extension of the output files which aren't encoded
+SOURCE_EXTENSION = '.mp3'
 
 # URL for last 7 days json data
-CURRENT_URL = r'https://audioapi.orf.at/oe1/api/json/current/broadcasts'
-DOWNLOAD_BASE_URL = r'https://loopstream01.apa.at/?channel=oe1&id='
+# can be pointed to a local server, e.g. by benchmarks/bench_offline.py
+CURRENT_URL = os.environ.get('OE1_CURRENT_URL', r'https://audioapi.orf.at/oe1/api/json/current/broadcasts')
+DOWNLOAD_BASE_URL = os.environ.get('OE1_DOWNLOAD_BASE_URL', r'https://loopstream01.apa.at/?channel=oe1&id=')
 
 INI_SECTION_DEFAULTS = {
     'TimeWindow':'00:00-24:00',
@@ -58,23 +140,342 @@ def repl_unsave(file_name):
     return re.sub(r'[\\/:"*?<>|]+', '_', tmp_str)
 
 
+def parse_duration(value):
+    """Converts a duration like "90", "15m", "12h" or "14d" to seconds"""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$', value)
+    if not m:
+        raise argparse.ArgumentTypeError('invalid duration: {!r}'.format(value))
+    return float(m.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+
+
+def section_rule(section_ini):
+    """Returns the rule of an ini file section, with its values completed by the defaults"""
+    sr = {}
+    sr['ini'] = INI_SECTION_DEFAULTS.copy()
+    sr['ini'].update({key: value for key, value in section_ini.items()})
+    m = re.match(r'\s*(\d\d):(\d\d)\s*\-\s*(\d\d):(\d\d)\s*', sr['ini']['TimeWindow'])
+    # seconds of the day, the end is inclusive and may be 24:00
+    sr['start_seconds'] = int(m.group(1)) * 3600 + int(m.group(2)) * 60
+    sr['end_seconds'] = int(m.group(3)) * 3600 + int(m.group(4)) * 60
+    sr['search_regexes'] = {
+        'title': re.compile(sr['ini']['title'], re.IGNORECASE)
+    }
+    sr['days'] = set(map(int, sr['ini']['Days'].split(',')))
+    sr['plan'] = OutputPlan(sr['ini'])
+    return sr
+
+
+def load_configuration(ini_fn):
+    """Returns the rules of all sections of an ini file, raises an exception for an invalid file"""
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str
+    with open(ini_fn, 'r', encoding='utf-8') as fin:
+        config.read_file(fin)
+    broadcasts_rules = {}
+    for section in config.sections():
+        try:
+            broadcasts_rules[section] = section_rule(config[section])
+        except ValueError as e:
+            raise ValueError('Section [{}]: {}'.format(section, e))
+        if not broadcasts_rules[section]['plan'].extension:
+            print('Warning: no extension for the output audio files of section [{}]'.format(section),
+                file=sys.stderr)
+    return broadcasts_rules
+
+
+def default_cache_file(download_basedir, cache_backend='file', cache_codec='json+bz2'):
+    return os.path.normpath(os.path.join(download_basedir, SQLITE_CACHE_FN
+        if cache_backend == 'sqlite' else CACHE_BASE_FN + CACHE_CODECS[cache_codec][2]))
+
+
+def http_session(max_connections=FETCH_WORKERS):
+    """Returns a keep-alive session with a connection pool of max_connections per host"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(max_connections, 1))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def tag_value(value):
+    """The value as it is written to a tag, with CRLF line breaks"""
+    return re.sub(r'\r\n|\r|\n', '\r\n', value)
+
+
+def register_id3_comment():
+    """EasyID3 has no comment key, MP3 files get their comment as an ID3 COMM frame"""
+    easy_id3 = importlib.import_module('mutagen.easyid3').EasyID3
+    if 'comment' in easy_id3.valid_keys:
+        return
+    id3 = importlib.import_module('mutagen.id3')
+
+    def get_comment(tags, key):
+        return [text for frame in tags.getall('COMM') for text in frame.text]
+
+    def set_comment(tags, key, value):
+        tags.delall('COMM')
+        tags.add(id3.COMM(encoding=3, lang='deu', desc='', text=value))
+
+    def delete_comment(tags, key):
+        tags.delall('COMM')
+
+    easy_id3.RegisterKey('comment', get_comment, set_comment, delete_comment)
+
+
 def tag_media_file(media_fn, tag_dict):
+    """Sets the tags of a media file, returns False if that failed"""
     if not os.path.isfile(media_fn):
         print('No such file to tag: {}'.format(media_fn), file=sys.stderr)
-        return
-    mf = mutagen.File(media_fn, easy=True)
-    for key, value in tag_dict.items():
-        value = re.sub(r'\r\n|\r|\n', '\r\n', value)
-        try:
+        return False
+    register_id3_comment()
+    try:
+        mf = mutagen.File(media_fn, easy=True)
+        if mf is None:
+            print('Unknown media file format, not tagged: {}'.format(media_fn), file=sys.stderr)
+            return False
+        for key, value in tag_dict.items():
+            value = tag_value(value)
             mf[key] = value
-            if key == 'comment':
+            # ID3 only has the comment
+            if key == 'comment' and not isinstance(mf.tags, mutagen.easyid3.EasyID3):
                 mf['description'] = value
-        except mutagen.MutagenError as e:
-            print('Error tagging {}: {}'.format(media_fn, e), file=sys.stderr)
+        mf.save()
+    except (mutagen.MutagenError, OSError) as e:
+        print('Error tagging {}: {}'.format(media_fn, e), file=sys.stderr)
+        return False
+    return True
+
+def read_tags(media_fn, tag_names):
+    """Returns the values of the given tags of a media file, as far as they are set"""
+    register_id3_comment()
+    try:
+        mf = mutagen.File(media_fn, easy=True)
+    except mutagen.MutagenError as e:
+        print('Error reading tags of {}: {}'.format(media_fn, e), file=sys.stderr)
+        return {}
+    if mf is None or mf.tags is None:
+        return {}
+    tags = {}
+    for tag_name in tag_names:
+        try:
+            values = mf.get(tag_name)
+        except (KeyError, ValueError):
+            continue
+        if values:
+            tags[tag_name] = '\r\n'.join(values)
+    return tags
+
+
+def digest(value):
+    """SHA-1 of a JSON serializable value"""
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def hash_chunks(chunks, source):
+    """Yields the chunks, their total size and SHA-1 are stored in the source dict at the end"""
+    sha1 = hashlib.sha1()
+    size = 0
+    for chunk in chunks:
+        sha1.update(chunk)
+        size += len(chunk)
+        yield chunk
+    source.update(download_size=size, source_hash=sha1.hexdigest())
+
+
+def file_source(fn):
+    """Returns the size and SHA-1 of a file like hash_chunks stores them"""
+    source = {}
+    with open(fn, 'rb') as fin:
+        for _ in hash_chunks(iter(functools.partial(fin.read, DOWNLOAD_CHUNK_SIZE), b''), source):
+            pass
+    return source
+
+
+def request_download(session, url, offset=0):
+    """Requests url starting at byte offset
+
+    Returns the response, the offset the response actually starts at and the total size (0 if unknown).
+    The response is None if there is nothing left to download after offset."""
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+    response = session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)
+    if offset and response.status_code == 416:
+        m = re.match(r'bytes \*/(\d+)', response.headers.get('content-range', ''))
+        if m and int(m.group(1)) == offset:
+            response.close()
+            return None, offset, offset
+    response.raise_for_status()
+    if offset and response.status_code == 206:
+        m = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('content-range', ''))
+        if not m or int(m.group(1)) != offset:
+            response.close()
+            raise IOError('Unexpected Content-Range for {}: {}'.format(url, response.headers.get('content-range')))
+        total = int(m.group(2)) if m.group(2) != '*' else 0
+    else:
+        # the server ignored the range, start from scratch
+        offset = 0
+        total = int(response.headers.get('content-length', 0))
+    return response, offset, total
+
+
+class Stopped(Exception):
+    """Raised by downloads and encodes when their stop event is set, e.g. after a KeyboardInterrupt"""
+
+
+def check_stop(stop, what):
+    if stop is not None and stop.is_set():
+        raise Stopped('Stopped {}'.format(what))
+
+
+def download_progress(desc, offset=0, total=0, position=None):
+    return tqdm(
+        desc=desc,
+        position=position,
+        initial=offset // DOWNLOAD_CHUNK_SIZE,
+        total=total // DOWNLOAD_CHUNK_SIZE,
+        leave=False,
+        unit='MB',
+        unit_scale=False)
+
+
+def iter_download(session, url, *, desc=None, stop=None, position=None):
+    """Yields the content of url in chunks while showing the download progress (in a fixed bar position)"""
+    response, offset, total = request_download(session, url)
+    with download_progress(desc, offset, total, position) as progress:
+        for data in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            check_stop(stop, desc or url)
+            progress.update()
+            yield data
+
+
+def complete_part_file(part_fn, download_fn, total):
+    """Renames a finished part file to download_fn if it has the expected size"""
+    size = os.path.getsize(part_fn)
+    if total and size > total:
+        os.remove(part_fn)
+        raise IOError('Download of {} is larger than expected: {} > {} bytes'.format(download_fn, size, total))
+    if total and size < total:
+        raise IOError('Incomplete download of {}: {} of {} bytes'.format(download_fn, size, total))
+    os.replace(part_fn, download_fn)
+
+
+def probe_range_support(session, url):
+    """Returns the total size of url if the server answers range requests, else 0"""
+    response = session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers={'Range': 'bytes=0-0'})
+    response.close()
+    if response.status_code != 206:
+        return 0
+    m = re.match(r'bytes 0-0/(\d+)', response.headers.get('content-range', ''))
+    return int(m.group(1)) if m else 0
+
+
+def download_segmented(session, url, part_fn, total, segments, *, desc=None, stop=None):
+    """Downloads url as byte ranges in parallel, written at their offsets into the preallocated part_fn
+
+    On errors, part_fn is truncated to its completely downloaded beginning, so it can be resumed."""
+    segment_size = -(-total // segments)
+    ranges = [(start, min(start + segment_size, total) - 1) for start in range(0, total, segment_size)]
+    written = [0] * len(ranges)
+    with open(part_fn, 'wb') as fout:
+        fout.truncate(total)
+    fd = os.open(part_fn, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        with download_progress(desc, 0, total) as progress:
+            def fetch_range(index):
+                start, end = ranges[index]
+                response = session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT,
+                    headers={'Range': 'bytes={}-{}'.format(start, end)})
+                response.raise_for_status()
+                if response.status_code != 206:
+                    response.close()
+                    raise IOError('Range request for {} not answered with partial content'.format(url))
+                for data in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    check_stop(stop, desc or url)
+                    if written[index] + len(data) > end - start + 1:
+                        raise IOError('Segment of {} is larger than requested'.format(url))
+                    os.pwrite(fd, data, start + written[index])
+                    written[index] += len(data)
+                    progress.update()
+                if written[index] != end - start + 1:
+                    raise IOError('Incomplete segment of {}: {} of {} bytes'.format(
+                        url, written[index], end - start + 1))
+
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                for future in [executor.submit(fetch_range, index) for index in range(len(ranges))]:
+                    future.result()
+    except:
+        complete = 0
+        for (start, end), count in zip(ranges, written):
+            complete += count
+            if count != end - start + 1:
+                break
+        os.ftruncate(fd, complete)
+        raise
+    finally:
+        os.close(fd)
+
+
+def hash_file(fin, sha1):
+    """Updates sha1 with the rest of the open file fin"""
+    for data in iter(functools.partial(fin.read, DOWNLOAD_CHUNK_SIZE), b''):
+        sha1.update(data)
+
+
+def download_file(session, url, download_fn, *, desc=None, retries=DOWNLOAD_RETRIES, segments=1, stop=None,
+        source=None):
+    """Downloads url to download_fn
+
+    The data is written to download_fn + PART_SUFFIX first, which is resumed with a range request
+    after an interruption, also in later runs. It is renamed to download_fn when it is complete.
+    With segments > 1, a new download is split into that many parallel range requests if the server
+    supports them.
+    If source is a dict, the size and SHA-1 of the download are stored in it like hash_chunks does. The chunks
+    are hashed as they arrive, after the beginning of a resumed part file; a segmented download is hashed once
+    it is complete, as its chunks arrive out of order."""
+    part_fn = download_fn + PART_SUFFIX
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_fn) if os.path.isfile(part_fn) else 0
+        try:
+            if segments > 1 and not offset and hasattr(os, 'pwrite'):
+                total = probe_range_support(session, url)
+                if total >= segments * DOWNLOAD_CHUNK_SIZE:
+                    download_segmented(session, url, part_fn, total, segments, desc=desc, stop=stop)
+                    complete_part_file(part_fn, download_fn, total)
+                    if source is not None:
+                        source.update(file_source(download_fn))
+                    return
+            response, offset, total = request_download(session, url, offset)
+            sha1 = hashlib.sha1()
+            with open(part_fn, 'r+b' if offset else 'wb') as fout:
+                if source is not None and offset:
+                    hash_file(fout, sha1)
+                if response is not None:
+                    with download_progress(desc, offset, total) as progress:
+                        fout.seek(offset)
+                        fout.truncate()
+                        for data in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            check_stop(stop, desc or url)
+                            fout.write(data)
+                            if source is not None:
+                                sha1.update(data)
+                            progress.update()
+            complete_part_file(part_fn, download_fn, total)
+            if source is not None:
+                source.update(download_size=os.path.getsize(download_fn), source_hash=sha1.hexdigest())
             return
-    mf.save()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries:
+                raise
+            tqdm.write('Download of {} interrupted, resuming: {}'.format(desc or url, e))
+
 
-def encode_audiofile(media_fn, conv_fn, *, length=None, ffmpeg_options=None, ffmpeg_executable=FFMPEG_EXECUTABLE):
+def ffmpeg_copies_audio(ffmpeg_options):
+    """True if the ffmpeg options copy the audio stream instead of encoding it"""
+    return any(option in ('-c', '-c:a', '-codec', '-codec:a', '-acodec') and value == 'copy'
+        for option, value in zip(ffmpeg_options, ffmpeg_options[1:]))
+
+
+def ffmpeg_command(media_fn, conv_fn, *, length=None, ffmpeg_options=None, ffmpeg_executable=FFMPEG_EXECUTABLE):
     command_list = [ffmpeg_executable, '-y']
     if length is not None:
         command_list.extend(['-t', str(length)])
@@ -82,68 +483,437 @@ def encode_audiofile(media_fn, conv_fn, *, length=None, ffmpeg_options=None, ffm
     if ffmpeg_options is None:
         command_list.extend(['-c:a', 'libopus', '-b:a', '36k', '-vbr', 'on',
             '-compression_level', '10', '-frame_duration', '60', '-application', 'voip'])
-    else:
+    elif isinstance(ffmpeg_options, str):
         command_list += ffmpeg_options.split(' ')
+    else:
+        command_list += ffmpeg_options
 
-    command_list.extend(['-sample_fmt', 's16'])
+    # a copied stream keeps its sample format
+    if not ffmpeg_copies_audio(command_list):
+        command_list.extend(['-sample_fmt', 's16'])
     command_list.extend([conv_fn])
-    try:
-        ffmpeg = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-        stdout, stderr = ffmpeg.communicate()
-        if ffmpeg.returncode != 0:
+    return command_list
+
+
+FFMPEG_DURATION_RE = re.compile(r'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)')
+FFMPEG_TIME_RE = re.compile(r'time=(\d+):(\d\d):(\d\d(?:\.\d+)?)')
+
+
+def ffmpeg_seconds(match):
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class FFmpegProcess:
+    """An ffmpeg child process with its resource usage
+
+    A thread reads stderr for the duration of the input and the time encoded so far, wait() reaps the child
+    with os.wait4 for its CPU times and peak memory, which Popen.wait() discards. When the stop event is set,
+    wait() kills ffmpeg and check() raises Stopped, so the caller removes the incomplete output.
+    Unless the input is piped, stdin is /dev/null: ffmpeg reads keys from the terminal otherwise, and several
+    of them running concurrently garble its settings."""
+
+    def __init__(self, command_list, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stop=None):
+        self.command_list = command_list
+        self.stop = stop
+        self.stopped = False
+        self.started_at = time.perf_counter()
+        self.wall_time = None
+        self.input_duration = None
+        self.encoded_time = None
+        self.rusage = None
+        # the child can only be reaped once, a second waiter has to wait for the first
+        self._wait_lock = threading.Lock()
+        self.popen = subprocess.Popen(command_list, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE, shell=False)
+        self._stderr_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_reader.start()
+
+    @property
+    def returncode(self):
+        return self.popen.returncode
+
+    def _read_stderr(self):
+        # universal newlines also split the stats lines, which ffmpeg ends with \r
+        for line in io.TextIOWrapper(self.popen.stderr, encoding='utf-8', errors='replace'):
+            if self.input_duration is None:
+                match = FFMPEG_DURATION_RE.search(line)
+                if match:
+                    self.input_duration = ffmpeg_seconds(match)
+            match = FFMPEG_TIME_RE.search(line)
+            if match:
+                self.encoded_time = ffmpeg_seconds(match)
+
+    def wait(self):
+        with self._wait_lock:
+            self._wait()
+        self._stderr_reader.join()
+        return self.popen.returncode
+
+    def _wait(self):
+        while self.popen.returncode is None:
+            if self.stop is not None and self.stop.is_set() and not self.stopped:
+                self.stopped = True
+                self.send_kill()
+            # without a stop event, there is nothing to poll for
+            timeout = FFMPEG_POLL_INTERVAL if self.stop is not None and not self.stopped else None
+            if hasattr(os, 'wait4'):
+                pid, status, rusage = os.wait4(self.popen.pid, 0 if timeout is None else os.WNOHANG)
+                if pid:
+                    self.rusage = rusage
+                    self.popen.returncode = \
+                        -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                else:
+                    time.sleep(timeout)
+            else:
+                try:
+                    self.popen.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    pass
+            if self.popen.returncode is not None:
+                self.wall_time = time.perf_counter() - self.started_at
+
+    def send_kill(self):
+        """Kills ffmpeg without waiting for it"""
+        if not hasattr(os, 'wait4'):
+            self.popen.kill()
+            return
+        # Popen.kill() polls first, which can reap the child before wait4 gets its resource usage
+        try:
+            os.kill(self.popen.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        """Kills ffmpeg unless it has finished, safe while another thread waits for it"""
+        if self.popen.returncode is None:
+            self.send_kill()
+            self.wait()
+
+    def check(self):
+        returncode = self.wait()
+        if self.stopped:
+            raise Stopped('Stopped ffmpeg: {}'.format(self.command_list[-1]))
+        if returncode != 0:
             raise IOError('FFmpeg conversion error, exit code: {}, command:\n{}'.format(
-                ffmpeg.returncode, ' '.join(command_list)))
+                self.popen.returncode, ' '.join(self.command_list)))
+
+    def stats(self, conv_fn):
+        """The resource usage of the finished encode of conv_fn
+
+        audio_duration is the length of the encoded audio, the input's may be unknown for pipes or cut by -t."""
+        duration = self.encoded_time or self.input_duration
+        stats = {
+            'input_duration': self.input_duration,
+            'audio_duration': duration,
+            'output_size': os.path.getsize(conv_fn) if os.path.isfile(conv_fn) else 0,
+            'wall_time': self.wall_time,
+            'realtime_factor': duration / self.wall_time if duration and self.wall_time else None,
+        }
+        if self.rusage is not None:
+            stats['user_time'] = self.rusage.ru_utime
+            stats['system_time'] = self.rusage.ru_stime
+            # kilobytes on Linux, bytes on macOS
+            stats['max_rss'] = self.rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return stats
+
+
+def encode_audiofile(media_fn, conv_fn, *, length=None, ffmpeg_options=None, ffmpeg_executable=FFMPEG_EXECUTABLE,
+        progress=None, stop=None):
+    """Converts media_fn to conv_fn, progress is called with the seconds of audio encoded so far
+
+    Returns the resource usage of ffmpeg, see FFmpegProcess.stats()."""
+    command_list = ffmpeg_command(media_fn, conv_fn, length=length, ffmpeg_options=ffmpeg_options,
+        ffmpeg_executable=ffmpeg_executable)
+    ffmpeg = None
+    try:
+        if progress is None:
+            ffmpeg = FFmpegProcess(command_list, stop=stop)
+        else:
+            command_list[1:1] = ['-progress', 'pipe:1', '-nostats']
+            ffmpeg = FFmpegProcess(command_list, stdout=subprocess.PIPE, stop=stop)
+            for line in io.TextIOWrapper(ffmpeg.popen.stdout, encoding='utf-8', errors='replace'):
+                # ffmpeg reports its progress twice per second, check() kills it
+                if stop is not None and stop.is_set():
+                    break
+                key, _, value = line.strip().partition('=')
+                if key in ('out_time_us', 'out_time_ms') and value.isdigit():
+                    ffmpeg.encoded_time = int(value) / 1000000
+                    progress(ffmpeg.encoded_time)
+        ffmpeg.check()
+        return ffmpeg.stats(conv_fn)
     except:
+        if ffmpeg is not None:
+            ffmpeg.kill()
         # remove incomplete file
         if os.path.isfile(conv_fn):
             os.remove(conv_fn)
         raise
 
 
+def encode_stream(chunks, conv_fn, *, tee_fn=None, length=None, ffmpeg_options=None,
+        ffmpeg_executable=FFMPEG_EXECUTABLE, stop=None):
+    """Pipes the chunks into ffmpeg's stdin, optionally writing them to tee_fn as well
+
+    On errors, the chunks written so far are kept in tee_fn + PART_SUFFIX, which download_file resumes.
+    Returns the resource usage of ffmpeg, see FFmpegProcess.stats()."""
+    command_list = ffmpeg_command('pipe:0', conv_fn, length=length, ffmpeg_options=ffmpeg_options,
+        ffmpeg_executable=ffmpeg_executable)
+    ffmpeg = FFmpegProcess(command_list, stdin=subprocess.PIPE, stop=stop)
+    stdin = ffmpeg.popen.stdin
+    tee_part_fn = tee_fn + PART_SUFFIX if tee_fn else None
+    try:
+        with open(tee_part_fn, 'wb') if tee_fn else contextlib.nullcontext() as tee:
+            for data in chunks:
+                if tee is not None:
+                    tee.write(data)
+                if stdin.closed:
+                    continue
+                try:
+                    stdin.write(data)
+                except BrokenPipeError:
+                    # ffmpeg stops reading early when the length is limited, only the tee needs the rest
+                    stdin.close()
+                    if tee is None:
+                        break
+        if not stdin.closed:
+            stdin.close()
+        ffmpeg.check()
+        if tee_fn:
+            os.replace(tee_part_fn, tee_fn)
+        return ffmpeg.stats(conv_fn)
+    except:
+        # a closed stdin also ends the children of a wrapper script still reading it
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+        ffmpeg.kill()
+        # remove the incomplete conversion, the tee's part file is resumed
+        if os.path.isfile(conv_fn):
+            os.remove(conv_fn)
+        raise
+
+
+DownloadJob = namedtuple('DownloadJob',
+    'section broadcast metadata target_dir target_fn download_fn conversion_fn ffmpeg_options source')
+# a DownloadJob on its way through the pipeline, action as returned by BroadcastsDownloader._state_action()
+PipelineJob = namedtuple('PipelineJob', 'job action newly_converted')
+
+
+def template_fields(template):
+    """Returns the names of the fields a str.format() template refers to"""
+    fields = set()
+    for _, field_name, format_spec, _ in string.Formatter().parse(template):
+        if field_name is not None:
+            # "scheduled_start.year" or "tags[0]" refer to the field before the first "." or "["
+            fields.add(re.match(r'[^.\[]*', field_name).group(0))
+        if format_spec and '{' in format_spec:
+            fields.update(template_fields(format_spec))
+    return fields
+
+
+def compile_template(template):
+    """Returns a callable rendering a str.format() template with a mapping, the template is parsed only once"""
+    formatter = string.Formatter()
+    parts = []
+    for literal, field_name, format_spec, conversion in formatter.parse(template):
+        if format_spec and '{' in format_spec:
+            # nested replacement fields in the format spec are left to str.format_map
+            return template.format_map
+        if field_name is None:
+            getter = None
+        elif re.fullmatch(r'\w+', field_name):
+            getter = operator.itemgetter(field_name)
+        else:
+            getter = functools.partial(lambda field_name, mapping: formatter.get_field(field_name, (), mapping)[0],
+                field_name)
+        parts.append((literal, getter, format_spec, conversion))
+
+    def render(mapping):
+        rendered = []
+        for literal, getter, format_spec, conversion in parts:
+            rendered.append(literal)
+            if getter is not None:
+                value = getter(mapping)
+                if conversion:
+                    value = formatter.convert_field(value, conversion)
+                rendered.append(format(value, format_spec))
+        return ''.join(rendered)
+    return render
+
+
+STRIP_RE = re.compile(r'^[\r\n\s]+|[\r\n\s]+$')
+WHITESPACE_RE = re.compile(r'[\n\r\s]+')
+LINK_RE = re.compile(r'<a[\s>]', re.IGNORECASE)
+
+
+def html_to_text(html, ignore_links=True):
+    # HTML2Text instances keep parser state (e.g. an unclosed blockquote) between handle() calls,
+    # so every conversion gets a new one; creating it is cheap compared to the conversion itself
+    h = html2text.HTML2Text()
+    h.ignore_links = ignore_links
+    return h.handle(html)
+
+
+def text_cache_key(html, ignore_links=True):
+    """The key of a conversion in the TextCache
+
+    Without links ignore_links makes no difference, so both variants share the same conversion."""
+    ignore_links = ignore_links and LINK_RE.search(html) is not None
+    options = 'html2text={};ignore_links={}'.format('.'.join(map(str, html2text.__version__)), ignore_links)
+    return hashlib.sha1((options + '\0' + html).encode('utf-8')).hexdigest(), ignore_links
+
+
+class BroadcastMetadata(collections.abc.Mapping):
+    """The metadata of a broadcast for the ini file templates
+
+    Values are computed when they are accessed for the first time, so the html2text conversions only
+    run for broadcasts and fields which are actually used."""
+
+    FIELDS = ('id', 'title', 'subtitle', 'href', 'url', 'tags', 'scheduled_start', 'extended_info',
+        'extended_info_text_only', 'info_1line', 'info_1line_limited', 'download_url')
+
+    def __init__(self, broadcast, text_cache=None):
+        self.broadcast = broadcast
+        self.text_cache = text_cache
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self.FIELDS:
+                raise KeyError(key)
+            self._values[key] = getattr(self, '_' + key)()
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def clear(self):
+        self._values.clear()
+
+    @property
+    def data(self):
+        return self.broadcast.data
+
+    def _to_text(self, html, ignore_links=True):
+        if self.text_cache is not None:
+            return self.text_cache.convert(html, ignore_links)
+        return html_to_text(html, ignore_links=ignore_links and LINK_RE.search(html) is not None)
+
+    def _id(self):
+        return self.data['id']
+
+    def _title(self):
+        return (self.data.get('title', None) or '').strip()
+
+    def _subtitle(self):
+        return STRIP_RE.sub('', self._to_text((self.data.get('subtitle', None) or '')).strip())
+
+    def _href(self):
+        return self.data.get('href', None) or ''
+
+    def _url(self):
+        return self.data.get('url', None) or ''
+
+    def _tags(self):
+        return ', '.join(self.data.get('tags', []))
+
+    def _scheduled_start(self):
+        return datetime.datetime.fromtimestamp(int(self.data['scheduledStart']) // 1000)
+
+    def _texts(self):
+        texts = []
+        for key in 'subtitle,description,pressRelease,akm'.split(','):
+            value = STRIP_RE.sub('', self.data.get(key, None) or '')
+            if value:
+                texts.append(value)
+        return texts
+
+    def _extended_info(self):
+        return '\n\n'.join((STRIP_RE.sub('', self._to_text(t, ignore_links=False)) for t in self._texts()))
+
+    def _extended_info_text_only(self):
+        # texts without links are the same as in extended_info, _to_text reuses their conversion
+        return '\n\n'.join((STRIP_RE.sub('', self._to_text(t)) for t in self._texts()))
+
+    def _info_1line(self):
+        return WHITESPACE_RE.sub(' ', self['extended_info_text_only'])
+
+    def _info_1line_limited(self):
+        return self['info_1line'][0:120]
+
+    def _download_url(self):
+        return self.broadcast.download_url
+
+
+# the fields available in the TargetDir, TargetName and Tag* templates
+TEMPLATE_FIELDS = frozenset(('SECTION', 'DOWNLOAD_BASEDIR') + BroadcastMetadata.FIELDS)
+
+
+class OutputPlan:
+    """How the broadcasts of an ini file section are named, encoded and tagged
+
+    Compiled once per section: the templates are checked against TEMPLATE_FIELDS, so a typo is a
+    configuration error instead of an exception for every broadcast."""
+
+    # the first FFmpegArguments match decides the extension of the output file
+    EXTENSIONS = (('opus', '.opus'), ('mp3', '.mp3'), ('vorbis', '.ogg'), ('aac', '.m4a'))
+    # FFmpegArguments values which don't encode: "copy" remuxes the original with ffmpeg, "link" doesn't run
+    # ffmpeg at all and stores the original under the target name
+    MODES = {'copy': ['-c:a', 'copy'], 'link': ['link']}
+
+    def __init__(self, section_ini):
+        templates = {key: value for key, value in section_ini.items()
+            if key in ('TargetDir', 'TargetName') or key.startswith('Tag')}
+        for key, template in templates.items():
+            try:
+                fields = template_fields(template)
+            except ValueError as e:
+                raise ValueError('{}: {}'.format(key, e))
+            unknown_fields = fields - TEMPLATE_FIELDS
+            if unknown_fields:
+                raise ValueError('{}: unknown field(s) {}'.format(key, ', '.join(sorted(unknown_fields))))
+        self.target_dir = compile_template(templates['TargetDir'])
+        self.target_name = compile_template(templates['TargetName'])
+        self.tags = {key[3:].lower(): compile_template(template) for key, template in templates.items()
+            if key.startswith('Tag')}
+        ffmpeg_options = section_ini['FFmpegArguments'].lower()
+        self.mode = ffmpeg_options.strip() if ffmpeg_options.strip() in self.MODES else 'encode'
+        self.ffmpeg_args = self.MODES.get(self.mode) or section_ini['FFmpegArguments'].split(' ')
+        if self.mode != 'encode' or ffmpeg_copies_audio(self.ffmpeg_args):
+            self.extension = SOURCE_EXTENSION
+        else:
+            self.extension = next((extension for codec, extension in self.EXTENSIONS if codec in ffmpeg_options), '')
+        self.keep_original = section_ini['KeepOriginal'].lower() != 'false'
+
+    def tag_dict(self, metadata):
+        return {tag_name: template(metadata) for tag_name, template in self.tags.items()}
+
+
 class Broadcast:
-    def __init__(self, initial_data_dict=None):
+    def __init__(self, initial_data_dict=None, text_cache=None):
         self.data = {}
-        self.metadata = {}
+        self.metadata = BroadcastMetadata(self, text_cache)
         if initial_data_dict is not None:
             self.update_data(initial_data_dict)
 
     def update_data(self, update_dict):
         self.data.update(update_dict)
-        strip_re = re.compile(r'^[\r\n\s]+|[\r\n\s]+$')
-        h = html2text.HTML2Text()
-        h.ignore_links = True
-        scheduled_start = datetime.datetime.fromtimestamp(int(self.data['scheduledStart']) // 1000)
-        self.metadata.update({
-            'id': self.data['id'],
-            'title': (self.data.get('title', None) or '').strip(),
-            'subtitle': strip_re.sub('', h.handle((self.data.get('subtitle', None) or '')).strip()),
-            'href': self.data.get('href', None) or '',
-            'url': self.data.get('url', None) or '',
-            'tags': ', '.join(self.data.get('tags', [])),
-            'scheduled_start': scheduled_start,
-            'extended_info': '',
-            'extended_info_text_only': '',
-            'info_1line': '',
-            'info_1line_limited': '',
-            'download_url': self.download_url,
-        })
-        text = []
-        for key in 'subtitle,description,pressRelease,akm'.split(','):
-            value = strip_re.sub('', self.data.get(key, None) or '')
-            if value:
-                text.append(value)
-        if text:
-            h.ignore_links = False
-            self.metadata['extended_info'] = '\n\n'.join((strip_re.sub('', h.handle(t)) for t in text))
-            h.ignore_links = True
-            self.metadata['extended_info_text_only'] = '\n\n'.join((strip_re.sub('', h.handle(t)) for t in text))
-            self.metadata['info_1line'] = re.sub(r'[\n\r\s]+', ' ', self.metadata['extended_info_text_only'])
-            self.metadata['info_1line_limited'] = self.metadata['info_1line'][0:120]
+        self.metadata.clear()
 
     @property
     def id(self):
         return self.data['id']
 
+    @property
+    def duration(self):
+        """Duration in seconds or None if it is unknown"""
+        duration = self.data.get('duration', None)
+        return int(duration) // 1000 if duration else None
+
     @property
     def scheduled_datetime(self):
         return datetime.datetime.fromtimestamp(int(self.data['scheduledStart']) // 1000)
@@ -152,6 +922,10 @@ class Broadcast:
     def download_filename(self):
         return repl_unsave(self.data['streams'][0]['loopStreamId'])
 
+    @property
+    def loop_stream_id(self):
+        return self.data['streams'][0]['loopStreamId']
+
     @property
     def download_url(self):
         return DOWNLOAD_BASE_URL + self.download_filename
@@ -160,6 +934,822 @@ class Broadcast:
         return '{scheduled_start:%Y-%m-%d %Hh%M} Ö1 {title} {info_1line_limited}'.format_map(self.metadata)
 
 
+def optional_import(name):
+    """Returns the module or None if it is not installed"""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def _zstd():
+    # Python 3.14+ ships zstd, otherwise the zstandard package is needed
+    zstd = optional_import('compression.zstd')
+    if zstd is not None:
+        return zstd.compress, zstd.decompress
+    zstandard = optional_import('zstandard')
+    if zstandard is not None:
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    return None
+
+
+def _lz4():
+    lz4_frame = optional_import('lz4.frame')
+    return (lz4_frame.compress, lz4_frame.decompress) if lz4_frame is not None else None
+
+
+def _json():
+    # orjson is a lot faster, if it is installed
+    orjson = optional_import('orjson')
+    if orjson is not None:
+        return orjson.dumps, orjson.loads
+
+    def dumps(data):
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+    def loads(raw):
+        return json.loads(raw.decode('utf-8'))
+
+    return dumps, loads
+
+
+def _msgpack():
+    msgpack = optional_import('msgpack')
+    if msgpack is None:
+        return None
+    return (functools.partial(msgpack.packb, use_bin_type=True),
+        functools.partial(msgpack.unpackb, raw=False, strict_map_key=False))
+
+
+# serializer, compressor and extension of the cache codecs
+CACHE_CODECS = {
+    'json+bz2': (_json, lambda: (functools.partial(bz2.compress, compresslevel=9), bz2.decompress), '.json.bz2'),
+    'json+zstd': (_json, _zstd, '.json.zst'),
+    'json+lz4': (_json, _lz4, '.json.lz4'),
+    'msgpack+zstd': (_msgpack, _zstd, '.msgpack.zst'),
+    'json': (_json, lambda: (bytes, bytes), '.json'),
+}
+# magic bytes of the compressed formats
+CACHE_COMPRESSION_HEADERS = (
+    (b'BZh', 'json+bz2'),
+    (b'\x28\xb5\x2f\xfd', 'json+zstd'),
+    (b'\x04\x22\x4d\x18', 'json+lz4'),
+)
+
+
+def cache_codec_missing(codec):
+    """Returns the name of the missing module for the codec or an empty string if it can be used"""
+    serializer, compressor, _ = CACHE_CODECS[codec]
+    if serializer() is None:
+        return codec.split('+')[0]
+    if compressor() is None:
+        return codec.split('+')[-1]
+    return ''
+
+
+def encode_cache(data, codec):
+    serializer, compressor, _ = CACHE_CODECS[codec]
+    return compressor()[0](serializer()[0](data))
+
+
+def decode_cache(raw):
+    """Decodes cache data of any codec, detected by the header of the compression format"""
+    for header, codec in CACHE_COMPRESSION_HEADERS:
+        if raw.startswith(header):
+            raw = CACHE_CODECS[codec][1]()[1](raw)
+            break
+    # a JSON object starts with "{" (maybe after whitespace), a msgpack map with one of these bytes
+    if raw[:1] in b'\x80\x81\x82\x83\x84\x85\x86\x87\x88\x89\x8a\x8b\x8c\x8d\x8e\x8f\xde\xdf':
+        return CACHE_CODECS['msgpack+zstd'][0]()[1](raw)
+    return CACHE_CODECS['json'][0]()[1](raw)
+
+
+class RuleIndex:
+    """The sections' rules, bucketed by weekday and time interval
+
+    The time intervals of a weekday are delimited by the start and end times of all sections, so each
+    section either covers an interval completely or not at all. A broadcast is only tested against the
+    title patterns of the sections covering its interval."""
+
+    def __init__(self, broadcasts_rules):
+        self.broadcasts_rules = broadcasts_rules
+        self.boundaries = {}
+        self.rules = {}
+        self.buckets = {}
+        for weekday in range(7):
+            rules = [(section, rule) for section, rule in broadcasts_rules.items() if weekday in rule['days']]
+            self.rules[weekday] = rules
+            self.boundaries[weekday] = sorted({0}.union(
+                *({rule['start_seconds'], rule['end_seconds'] + 1} for section, rule in rules)))
+
+    def sections(self, weekday, seconds):
+        """Returns the sections whose days and time window cover a time, in configuration order"""
+        interval = bisect.bisect_right(self.boundaries[weekday], seconds) - 1
+        key = weekday, interval
+        if key not in self.buckets:
+            start = self.boundaries[weekday][interval]
+            self.buckets[key] = tuple(
+                (section, rule['search_regexes']['title']) for section, rule in self.rules[weekday]
+                if rule['start_seconds'] <= start <= rule['end_seconds'])
+        return self.buckets[key]
+
+    def match(self, weekday, seconds, title):
+        """Returns the first section covering the time whose title pattern matches, or an empty string"""
+        for section, title_regex in self.sections(weekday, seconds):
+            if title_regex.search(title):
+                return section
+        return ''
+
+
+class ScheduleTable:
+    """The broadcasts of a schedule as NumPy columns, for evaluating the days and time windows of a
+    section for all broadcasts at once; only the remaining candidates are searched with the title regex"""
+
+    def __init__(self, broadcasts):
+        np = importlib.import_module('numpy')
+        self.broadcasts = broadcasts
+        starts = np.fromiter((int(broadcast['scheduledStart']) // 1000 for broadcast in broadcasts),
+            dtype=np.int64, count=len(broadcasts))
+        local_starts = starts + self._utc_offsets(np, starts)
+        # 1970-01-01 was a Thursday
+        self.weekdays = (local_starts // 86400 + 3) % 7
+        self.seconds = local_starts % 86400
+        # the same titles come up every week, each one is only searched once per section
+        codes = {}
+        self.title_codes = np.fromiter((codes.setdefault(broadcast['title'], len(codes)) for broadcast in broadcasts),
+            dtype=np.int64, count=len(broadcasts))
+        self.titles = list(codes)
+
+    @staticmethod
+    def _utc_offsets(np, starts):
+        """The local UTC offset of every start, looked up once per hour, or per start in hours with a change"""
+        hours, inverse = np.unique(starts // 3600, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        hour_starts = np.array([time.localtime(int(hour) * 3600).tm_gmtoff for hour in hours], dtype=np.int64)
+        hour_ends = np.array([time.localtime(int(hour) * 3600 + 3599).tm_gmtoff for hour in hours], dtype=np.int64)
+        offsets = hour_starts[inverse]
+        for index in np.flatnonzero((hour_starts != hour_ends)[inverse]).tolist():
+            offsets[index] = time.localtime(int(starts[index])).tm_gmtoff
+        return offsets
+
+    def match(self, broadcasts_rules):
+        """Returns the first section of interest of every broadcast in configuration order, or an empty string"""
+        np = importlib.import_module('numpy')
+        sections = [''] * len(self.broadcasts)
+        unmatched = np.ones(len(self.broadcasts), dtype=bool)
+        for section, rule in broadcasts_rules.items():
+            candidates = np.flatnonzero(
+                unmatched
+                & np.isin(self.weekdays, sorted(rule['days']))
+                & (self.seconds >= rule['start_seconds'])
+                & (self.seconds <= rule['end_seconds']))
+            if not len(candidates):
+                continue
+            regex = rule['search_regexes']['title']
+            title_matches = {}
+            for index, code in zip(candidates.tolist(), self.title_codes[candidates].tolist()):
+                if code not in title_matches:
+                    try:
+                        title_matches[code] = regex.search(self.titles[code]) is not None
+                    except Exception as e:
+                        tqdm.write('Error {} {}'.format(self.broadcasts[index], e))
+                        title_matches[code] = False
+                if title_matches[code]:
+                    sections[index] = section
+                    unmatched[index] = False
+        return sections
+
+
+class FileCache(dict):
+    """Broadcast data by href, stored as one compressed snapshot file plus a journal
+
+    New entries are appended to the journal (JSON lines) as soon as they are set, so an interrupted run
+    keeps them. The journal is merged into a new snapshot when it has grown to JOURNAL_MAX_ENTRIES.
+    Evicted entries stay in the snapshot, and are evicted again after loading it, until they amount to
+    CACHE_COMPACT_FRACTION of the entries.
+    A read_only cache is never written by close(), e.g. for listing the entries of another codec."""
+
+    def __init__(self, cache_fn, codec='json+bz2', read_only=False):
+        super().__init__()
+        self.cache_fn = cache_fn
+        self.journal_fn = cache_fn + JOURNAL_SUFFIX
+        self.codec = codec
+        self.read_only = read_only
+        self.evicted = 0
+        self.journal_entries = 0
+        self._journal = None
+
+    def load(self, cache_fn=None):
+        if cache_fn or not os.path.isfile(self.journal_fn) or os.path.isfile(self.cache_fn):
+            with open(cache_fn or self.cache_fn, 'rb') as fin:
+                self.update(decode_cache(fin.read()))
+        if not cache_fn and os.path.isfile(self.journal_fn):
+            with open(self.journal_fn, 'rb') as fin:
+                for line in fin:
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # the last line may be incomplete after a crash
+                        continue
+                    self.journal_entries += 1
+                    dict.__setitem__(self, entry['href'], entry['data'])
+
+    def __setitem__(self, href, data):
+        super().__setitem__(href, data)
+        if self._journal is None:
+            self._journal = open(self.journal_fn, 'ab')
+        self._journal.write(json.dumps({'href': href, 'data': data}, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._journal.flush()
+        self.journal_entries += 1
+
+    def evict(self, max_age=0, max_entries=0):
+        """Removes the entries of broadcasts scheduled more than max_age seconds ago (and those without a
+        scheduled start) and the oldest entries beyond max_entries, returns the number of removed entries"""
+        before = len(self)
+        if max_age:
+            cutoff = (time.time() - max_age) * 1000
+            for href in [href for href, data in self.items() if int(data.get('scheduledStart') or 0) < cutoff]:
+                del self[href]
+        if max_entries and len(self) > max_entries:
+            by_age = sorted(self, key=lambda href: int(self[href].get('scheduledStart') or 0))
+            for href in by_age[:len(self) - max_entries]:
+                del self[href]
+        self.evicted += before - len(self)
+        return before - len(self)
+
+    def save(self):
+        """Writes a new snapshot, atomically replacing the old one, and empties the journal"""
+        tmp_fn = self.cache_fn + '.tmp'
+        with open(tmp_fn, 'wb') as fout:
+            fout.write(encode_cache(self, self.codec))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_fn, self.cache_fn)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.isfile(self.journal_fn):
+            os.remove(self.journal_fn)
+        self.journal_entries = 0
+        self.evicted = 0
+
+    def flush(self):
+        """Writes a snapshot if enough entries were evicted or the journal has grown large enough"""
+        compact = self.evicted and self.evicted >= len(self) * CACHE_COMPACT_FRACTION
+        if (self or self.evicted) and (compact or self.journal_entries >= JOURNAL_MAX_ENTRIES
+                or not os.path.isfile(self.cache_fn)):
+            self.save()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not self.read_only:
+            self.flush()
+
+
+class SqliteCache(collections.abc.MutableMapping):
+    """Broadcast data by href, stored in an SQLite database
+
+    Every entry is written on its own when it is set, so nothing has to be loaded or saved as a whole,
+    and several processes can share the database (WAL mode). A read_only cache opens an existing database
+    without creating or changing anything. The pages of evicted entries are freed with incremental vacuuming,
+    which does not lock out the other processes like a VACUUM."""
+
+    def __init__(self, cache_fn, migrate_from=None, read_only=False):
+        self.cache_fn = cache_fn
+        if read_only:
+            self.db = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(cache_fn))),
+                uri=True, timeout=30, isolation_level=None)
+            return
+        self.db = sqlite3.connect(cache_fn, timeout=30, isolation_level=None)
+        # only takes effect for a new database, an older one is switched over by its next VACUUM in evict()
+        self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                href TEXT PRIMARY KEY,
+                broadcast_id INTEGER,
+                scheduled_start INTEGER,
+                fetched_at REAL NOT NULL,
+                data TEXT NOT NULL)""")
+        for column in ('broadcast_id', 'scheduled_start', 'fetched_at'):
+            self.db.execute('CREATE INDEX IF NOT EXISTS broadcasts_{0} ON broadcasts ({0})'.format(column))
+        if migrate_from and os.path.isfile(migrate_from) and not len(self):
+            self.migrate(migrate_from)
+
+    def migrate(self, cache_fn):
+        """Imports all entries of a FileCache"""
+        file_cache = FileCache(cache_fn)
+        file_cache.load()
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                'INSERT OR REPLACE INTO broadcasts VALUES (?, ?, ?, ?, ?)',
+                (self._row(href, data) for href, data in file_cache.items()))
+        print('Migrated {} entries from {} to {}'.format(len(file_cache), cache_fn, self.cache_fn))
+
+    @staticmethod
+    def _row(href, data):
+        scheduled_start = data.get('scheduledStart', None)
+        return (
+            href,
+            data.get('id', None),
+            int(scheduled_start) // 1000 if scheduled_start else None,
+            time.time(),
+            json.dumps(data, ensure_ascii=False))
+
+    def __getitem__(self, href):
+        row = self.db.execute('SELECT data FROM broadcasts WHERE href = ?', (href,)).fetchone()
+        if row is None:
+            raise KeyError(href)
+        return json.loads(row[0])
+
+    def __setitem__(self, href, data):
+        self.db.execute('INSERT OR REPLACE INTO broadcasts VALUES (?, ?, ?, ?, ?)', self._row(href, data))
+
+    def __delitem__(self, href):
+        if not self.db.execute('DELETE FROM broadcasts WHERE href = ?', (href,)).rowcount:
+            raise KeyError(href)
+
+    def __contains__(self, href):
+        return self.db.execute('SELECT 1 FROM broadcasts WHERE href = ?', (href,)).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self.db.execute('SELECT href FROM broadcasts').fetchall())
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM broadcasts').fetchone()[0]
+
+    def load(self):
+        pass
+
+    def save(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def evict(self, max_age=0, max_entries=0):
+        """Same as FileCache.evict, the free pages are returned to the file system"""
+        evicted = 0
+        if max_age:
+            evicted += self.db.execute(
+                'DELETE FROM broadcasts WHERE scheduled_start IS NULL OR scheduled_start < ?',
+                (int(time.time() - max_age),)).rowcount
+        if max_entries:
+            evicted += self.db.execute(
+                'DELETE FROM broadcasts WHERE href IN '
+                '(SELECT href FROM broadcasts ORDER BY scheduled_start '
+                'LIMIT max(0, (SELECT COUNT(*) FROM broadcasts) - ?))',
+                (max_entries,)).rowcount
+        if evicted:
+            if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                # execute() would only run its first step, which frees a single page
+                self.db.executescript('PRAGMA incremental_vacuum')
+            elif self.db.execute('PRAGMA freelist_count').fetchone()[0] >= \
+                    self.db.execute('PRAGMA page_count').fetchone()[0] * CACHE_COMPACT_FRACTION:
+                # a database without incremental vacuuming, switched over by this VACUUM
+                self.db.execute('VACUUM')
+        return evicted
+
+    def close(self):
+        self.db.close()
+
+
+class TextCache:
+    """html2text conversions by a hash of the HTML and the converter options
+
+    Unchanged descriptions are not converted again on every run. The entries are loaded at once and
+    the changes are written back in close(), the subclasses implement the storage. Conversions may run in
+    the encoding threads, hence the lock. With refresh, the cached conversions are not used but replaced,
+    like --no-cache does for the broadcast data."""
+
+    # the last use of an entry is only updated once per day, so reading it doesn't rewrite the cache
+    TOUCH_INTERVAL = 86400
+
+    def __init__(self, max_age=CACHE_MAX_AGE, refresh=False):
+        self.max_age = max_age
+        self.refresh = refresh
+        self.entries = {}
+        self.changed = set()
+        self.removed = set()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def convert(self, html, ignore_links=True):
+        key, ignore_links = text_cache_key(html, ignore_links)
+        now = time.time()
+        with self._lock:
+            entry = None if self.refresh else self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                if now - entry[1] > self.TOUCH_INTERVAL:
+                    entry[1] = now
+                    self.changed.add(key)
+                return entry[0]
+            self.misses += 1
+        text = html_to_text(html, ignore_links=ignore_links)
+        with self._lock:
+            self.entries[key] = [text, now]
+            self.changed.add(key)
+            self.removed.discard(key)
+        return text
+
+    def evict(self):
+        """Removes the entries which haven't been used for max_age seconds"""
+        if self.max_age:
+            cutoff = time.time() - self.max_age
+            for key in [key for key, (_, used_at) in self.entries.items() if used_at < cutoff]:
+                del self.entries[key]
+                self.changed.discard(key)
+                self.removed.add(key)
+
+    def flush(self):
+        self.evict()
+        if self.changed or self.removed:
+            self.save()
+            self.changed.clear()
+            self.removed.clear()
+
+    def close(self):
+        self.flush()
+
+
+class FileTextCache(TextCache):
+    """TextCache stored as one file next to a FileCache, using the same codec"""
+
+    def __init__(self, cache_fn, codec='json+bz2', max_age=CACHE_MAX_AGE, refresh=False):
+        super().__init__(max_age, refresh)
+        self.cache_fn = cache_fn
+        self.codec = codec
+        if os.path.isfile(cache_fn):
+            with open(cache_fn, 'rb') as fin:
+                self.entries = decode_cache(fin.read())
+
+    def save(self):
+        tmp_fn = self.cache_fn + '.tmp'
+        with open(tmp_fn, 'wb') as fout:
+            fout.write(encode_cache(self.entries, self.codec))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_fn, self.cache_fn)
+
+
+class SqliteTextCache(TextCache):
+    """TextCache stored in a table of the SqliteCache database
+
+    The database connection belongs to the main thread, so the table is only read and written in
+    __init__ and close()."""
+
+    def __init__(self, db, max_age=CACHE_MAX_AGE, refresh=False):
+        super().__init__(max_age, refresh)
+        self.db = db
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS html2text (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                used_at REAL NOT NULL)""")
+        self.entries = {key: [text, used_at] for key, text, used_at in
+            self.db.execute('SELECT key, text, used_at FROM html2text')}
+
+    def save(self):
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM html2text WHERE key = ?', ((key,) for key in self.removed))
+            self.db.executemany('INSERT OR REPLACE INTO html2text VALUES (?, ?, ?)',
+                ((key, *self.entries[key]) for key in self.changed))
+
+
+class StateStore:
+    """Completed broadcasts by their loopStreamId, stored in an SQLite database
+
+    An entry records where a broadcast was written to and with which FFmpeg arguments and tags, so a
+    broadcast is skipped without looking at the file system, even after a template change or a move of the
+    archive. All entries are read at once; they are written from the encoding threads, hence the lock."""
+
+    COLUMNS = ('loop_stream_id', 'broadcast_id', 'section', 'output_path', 'download_size', 'source_hash',
+        'ffmpeg_args_hash', 'tag_hash', 'downloaded_at', 'converted_at', 'tagged_at')
+
+    def __init__(self, state_fn):
+        self.state_fn = state_fn
+        self.db = sqlite3.connect(state_fn, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS completed (
+                loop_stream_id TEXT PRIMARY KEY,
+                broadcast_id INTEGER,
+                section TEXT,
+                output_path TEXT NOT NULL,
+                download_size INTEGER,
+                source_hash TEXT,
+                ffmpeg_args_hash TEXT,
+                tag_hash TEXT,
+                downloaded_at REAL,
+                converted_at REAL,
+                tagged_at REAL)""")
+        self._lock = threading.Lock()
+        self.entries = {row[0]: dict(zip(self.COLUMNS, row)) for row in
+            self.db.execute('SELECT {} FROM completed'.format(', '.join(self.COLUMNS)))}
+
+    def get(self, loop_stream_id):
+        return self.entries.get(loop_stream_id)
+
+    def record(self, loop_stream_id, **values):
+        """Updates the entry of a broadcast with the given column values"""
+        with self._lock:
+            entry = dict(self.entries.get(loop_stream_id) or dict.fromkeys(self.COLUMNS))
+            entry.update(values, loop_stream_id=loop_stream_id)
+            self.db.execute('INSERT OR REPLACE INTO completed VALUES ({})'.format(', '.join('?' * len(self.COLUMNS))),
+                [entry[column] for column in self.COLUMNS])
+            self.entries[loop_stream_id] = entry
+
+    def close(self):
+        self.db.close()
+
+
+class Pipeline:
+    """Stages of worker threads connected by bounded queues
+
+    A stage's function takes an item and returns the item for the next stage, or None when it is done with it.
+    A full queue blocks the stage in front of it, so e.g. downloads wait for the encoders instead of filling the
+    disk. on_error(item, exception) is called for the items whose stage failed, the others go on.
+
+    An interruption of run(), like KeyboardInterrupt or the SystemExit of a signal handler, sets the stop event.
+    The stage functions pass it on to the downloads and encodes, which stop and clean up, and the waiting items
+    are dropped. run() waits for that before it raises the interruption."""
+
+    _DONE = object()
+
+    def __init__(self, on_error, queue_size=PIPELINE_QUEUE_SIZE, stop=None):
+        self.on_error = on_error
+        self.queue_size = max(queue_size, 1)
+        self.stop = stop if stop is not None else threading.Event()
+        self.stages = []
+        self._done_sent = 0
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, func, workers=1):
+        self.stages.append({'name': name, 'func': func, 'workers': max(workers, 1), 'running': 0,
+            'queue': queue.Queue(self.queue_size)})
+
+    def _work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage['queue'].get()
+            if item is self._DONE:
+                break
+            # after an interruption, the queued items are only taken out so nobody blocks
+            if self.stop.is_set():
+                continue
+            try:
+                item = stage['func'](item)
+            except Exception as e:
+                if not self.stop.is_set():
+                    self.on_error(item, e)
+                continue
+            if item is not None and next_stage is not None:
+                next_stage['queue'].put(item)
+        with self._lock:
+            stage['running'] -= 1
+            last = stage['running'] == 0
+        if last and next_stage is not None:
+            for _ in range(next_stage['workers']):
+                next_stage['queue'].put(self._DONE)
+
+    def run(self, items):
+        """Feeds the items to the first stage and waits until all stages are done with them"""
+        threads = []
+        for index, stage in enumerate(self.stages):
+            stage['running'] = stage['workers']
+            for number in range(stage['workers']):
+                threads.append(threading.Thread(target=self._work, args=(index,),
+                    name='{} {}'.format(stage['name'], number + 1)))
+        for thread in threads:
+            thread.start()
+        interruption = None
+        try:
+            for item in items:
+                self.stages[0]['queue'].put(item)
+        except BaseException as e:
+            self.stop.set()
+            interruption = e
+        interruption = self._finish(threads) or interruption
+        if interruption is not None:
+            raise interruption
+
+    def _finish(self, threads):
+        """Ends the workers and waits for them, returns an interruption while waiting after stopping them"""
+        interruption = None
+        first = self.stages[0]
+        while True:
+            try:
+                while self._done_sent < first['workers']:
+                    first['queue'].put(self._DONE)
+                    self._done_sent += 1
+                for thread in threads:
+                    thread.join()
+                return interruption
+            except BaseException as e:
+                # the workers must not be abandoned while they run ffmpeg or write files
+                self.stop.set()
+                interruption = interruption or e
+
+
+class Metrics:
+    """Durations, sizes and failures of the stages of a run, and counters like cache hits
+
+    Every stage call is one event, labeled with the section and the broadcast id if it belongs to one.
+    The events are written as JSON lines and summed up for the Prometheus textfile collector."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.events = []
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        """Times the block as one event of stage name, the block may add e.g. 'bytes' to the yielded event"""
+        event = dict(labels, stage=name)
+        t0 = time.perf_counter()
+        try:
+            yield event
+        except Exception as e:
+            event['error'] = str(e)
+            raise
+        finally:
+            event['duration'] = time.perf_counter() - t0
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def summary(self):
+        """The events summed up by stage and section"""
+        totals = collections.OrderedDict()
+        for event in self.events:
+            key = (event['stage'], event.get('section', ''))
+            total = totals.setdefault(key, {'calls': 0, 'failures': 0, 'seconds': 0.0, 'bytes': 0})
+            total['calls'] += 1
+            total['failures'] += 'error' in event
+            total['seconds'] += event['duration']
+            total['bytes'] += event.get('bytes', 0)
+        return totals
+
+    def encode_summary(self, *keys):
+        """The resource usage of the successful ffmpeg runs summed up by the labels keys, e.g. 'section' or
+        'profile', with the realtime factor and the CPU seconds per hour of audio"""
+        totals = collections.OrderedDict()
+        for event in self.events:
+            if 'profile' not in event or 'error' in event:
+                continue
+            total = totals.setdefault(tuple(event[key] for key in keys), dict.fromkeys(
+                ('encodes', 'audio_duration', 'wall_time', 'user_time', 'system_time', 'output_size', 'max_rss'), 0))
+            total['encodes'] += 1
+            for name in ('audio_duration', 'wall_time', 'user_time', 'system_time', 'output_size'):
+                total[name] += event.get(name) or 0
+            total['max_rss'] = max(total['max_rss'], event.get('max_rss', 0))
+        for total in totals.values():
+            cpu_time = total['user_time'] + total['system_time']
+            total['realtime_factor'] = total['audio_duration'] / total['wall_time'] if total['wall_time'] else None
+            total['cpu_time_per_hour'] = \
+                cpu_time * 3600 / total['audio_duration'] if total['audio_duration'] else None
+        return totals
+
+    def write_json_lines(self, fn):
+        """Appends the events and a summary line of the run to fn"""
+        run = '{:.0f}'.format(self.started_at)
+        with open(fn, 'a', encoding='utf-8') as fout:
+            for event in self.events:
+                fout.write(json.dumps(dict(event, type='stage', run=run), ensure_ascii=False) + '\n')
+            fout.write(json.dumps({
+                'type': 'run',
+                'run': run,
+                'started_at': self.started_at,
+                'duration': time.time() - self.started_at,
+                'counters': self.counters,
+                'stages': [dict(total, stage=stage, section=section)
+                    for (stage, section), total in self.summary().items()],
+                'encodes_by_section': [dict(total, section=section)
+                    for (section,), total in self.encode_summary('section').items()],
+                'encodes_by_profile': [dict(total, profile=profile)
+                    for (profile,), total in self.encode_summary('profile').items()],
+            }, ensure_ascii=False) + '\n')
+
+    def write_prometheus(self, fn):
+        """Writes the summary in the Prometheus text format, atomically as the textfile collector needs it"""
+        def label_value(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = []
+        summary = self.summary()
+        for metric, key, help_text in (
+                ('oe1_get_stage_seconds', 'seconds', 'Time spent in a stage during the last run'),
+                ('oe1_get_stage_bytes', 'bytes', 'Bytes processed by a stage during the last run'),
+                ('oe1_get_stage_calls', 'calls', 'Calls of a stage during the last run'),
+                ('oe1_get_stage_failures', 'failures', 'Failed calls of a stage during the last run')):
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for (stage, section), total in summary.items():
+                lines.append('{}{{stage="{}",section="{}"}} {}'.format(
+                    metric, label_value(stage), label_value(section), total[key]))
+        encodes = self.encode_summary('section', 'profile')
+        for metric, key, help_text in (
+                ('oe1_get_encode_count', 'encodes', 'FFmpeg runs during the last run'),
+                ('oe1_get_encode_audio_seconds', 'audio_duration', 'Seconds of audio encoded during the last run'),
+                ('oe1_get_encode_wall_seconds', 'wall_time', 'Wall clock time of the FFmpeg runs'),
+                ('oe1_get_encode_user_seconds', 'user_time', 'User CPU time of the FFmpeg runs'),
+                ('oe1_get_encode_system_seconds', 'system_time', 'System CPU time of the FFmpeg runs'),
+                ('oe1_get_encode_output_bytes', 'output_size', 'Size of the encoded files'),
+                ('oe1_get_encode_max_rss_bytes', 'max_rss', 'Largest peak memory of an FFmpeg run')):
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for (section, profile), total in encodes.items():
+                lines.append('{}{{section="{}",profile="{}"}} {}'.format(
+                    metric, label_value(section), label_value(profile), total[key]))
+        lines.append('# HELP oe1_get_count Counters of the last run, like cache hits and misses')
+        lines.append('# TYPE oe1_get_count gauge')
+        for name, value in sorted(self.counters.items()):
+            lines.append('oe1_get_count{{name="{}"}} {}'.format(label_value(name), value))
+        lines.append('# HELP oe1_get_last_run_timestamp_seconds Start of the last run')
+        lines.append('# TYPE oe1_get_last_run_timestamp_seconds gauge')
+        lines.append('oe1_get_last_run_timestamp_seconds {:.3f}'.format(self.started_at))
+        lines.append('# HELP oe1_get_last_run_duration_seconds Duration of the last run')
+        lines.append('# TYPE oe1_get_last_run_duration_seconds gauge')
+        lines.append('oe1_get_last_run_duration_seconds {:.3f}'.format(time.time() - self.started_at))
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'w', encoding='utf-8') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        os.replace(tmp_fn, fn)
+
+
+class PhaseProfiler:
+    """Profiles the CPU time and the memory allocations of one phase of a run
+
+    Writes [fn_prefix].pstats for "python -m pstats" or snakeviz, and [fn_prefix].tracemalloc.txt with the
+    TRACEMALLOC_TOP allocation sites still alive at the end of the phase and [fn_prefix].tracemalloc, a
+    snapshot for comparisons."""
+
+    def __init__(self, fn_prefix, cpu=True, mem=False):
+        self.fn_prefix = fn_prefix
+        self.cpu = cpu
+        self.mem = mem
+        self._profile = None
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+
+    def _profile_thread(self, frame, event, arg):
+        # called once by each new thread, the thread's own profiler replaces this hook
+        profile = cProfile.Profile()
+        with self._lock:
+            self._thread_profiles.append(profile)
+        profile.enable()
+
+    def __enter__(self):
+        if self.mem:
+            tracemalloc.start()
+        if self.cpu:
+            self._profile = cProfile.Profile()
+            # before Python 3.12, a profiler only sees the thread it was enabled in
+            if sys.version_info < (3, 12):
+                threading.setprofile(self._profile_thread)
+            self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.cpu:
+                self._profile.disable()
+                threading.setprofile(None)
+            if self.mem:
+                # before collecting the CPU stats, which allocate a lot themselves
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+                    tracemalloc.Filter(False, tracemalloc.__file__)))
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                snapshot.dump(self.fn_prefix + '.tracemalloc')
+                with open(self.fn_prefix + '.tracemalloc.txt', 'w', encoding='utf-8') as fout:
+                    fout.write('current {:.1f} MiB, peak {:.1f} MiB\n'.format(current / 2 ** 20, peak / 2 ** 20))
+                    for statistic in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                        fout.write('{}\n'.format(statistic))
+            if self.cpu:
+                stats = pstats.Stats(self._profile)
+                with self._lock:
+                    for profile in self._thread_profiles:
+                        stats.add(profile)
+                stats.dump_stats(self.fn_prefix + '.pstats')
+            print('Profile written to {}.*'.format(self.fn_prefix), file=sys.stderr)
+        except Exception as e:
+            print('Error writing profile: {}, {}'.format(self.fn_prefix, e), file=sys.stderr)
+
+
 class BroadcastsDownloader:
     def __init__(
             self,
@@ -171,10 +1761,27 @@ class BroadcastsDownloader:
             reconvert=False,
             cache_file=None,
             length=0,
-            ffmpeg=FFMPEG_EXECUTABLE):
+            ffmpeg=FFMPEG_EXECUTABLE,
+            fetch_workers=FETCH_WORKERS,
+            engine='sync',
+            download_jobs=DOWNLOAD_JOBS,
+            encode_jobs=None,
+            tag_jobs=TAG_JOBS,
+            queue_size=PIPELINE_QUEUE_SIZE,
+            stream_encode=False,
+            download_segments=1,
+            schedule_max_age=0,
+            cache_backend='file',
+            cache_codec='json+bz2',
+            cache_max_age=CACHE_MAX_AGE,
+            cache_max_entries=0,
+            state_file=None,
+            metrics_file=None,
+            prometheus_file=None,
+            profile=None):
         self.download_basedir = download_basedir
         if not cache_file:
-            cache_file = os.path.normpath(os.path.join(self.download_basedir, HTML_CACHE_FN))
+            cache_file = default_cache_file(self.download_basedir, cache_backend, cache_codec)
         self.dry_run = dry_run
         self.no_cache = no_cache
         self.retag = retag
@@ -183,10 +1790,35 @@ class BroadcastsDownloader:
         self.he2 = False
         self.ini_fn = ini_file
         self.html_cache_fn = cache_file
+        self.cache_backend = cache_backend
+        self.cache_max_age = cache_max_age
+        self.cache_max_entries = cache_max_entries
+        self.schedule_fn = os.path.join(os.path.dirname(cache_file), SCHEDULE_CACHE_FN)
+        self.state_fn = state_file or os.path.join(self.download_basedir, STATE_DB_FN)
+        self.metrics_fn = metrics_file
+        self.prometheus_fn = prometheus_file
+        self.metrics = Metrics()
+        self.profile = profile
+        # set when the pipeline is interrupted, the running downloads and encodes stop
+        self._stop = threading.Event()
+        self.state = None
+        self.schedule_max_age = schedule_max_age
+        self.schedule_not_modified = False
         self.ffmpeg = ffmpeg
+        self.fetch_workers = max(fetch_workers, 1)
+        self.engine = engine
+        self.download_jobs = max(download_jobs, 1)
+        self.encode_jobs = max(encode_jobs or os.cpu_count() or 1, 1)
+        self.tag_jobs = max(tag_jobs, 1)
+        self.queue_size = max(queue_size, 1)
+        self.stream_encode = stream_encode
+        self.download_segments = max(download_segments, 1)
+        self.session = http_session(max(self.fetch_workers, self.download_jobs * self.download_segments))
         self.broadcasts_for_current_week = []
-        self.broadcasts_of_interest = defaultdict(set)
-        self.broadcasts_data = {}
+        self.schedule_of_interest = []
+        self.broadcasts_of_interest = defaultdict(list)
+        self.broadcasts_data = FileCache(self.html_cache_fn, cache_codec)
+        self.text_cache = None
         self.broadcasts_rules = {}
 
         try:
@@ -195,173 +1827,814 @@ class BroadcastsDownloader:
             print('Error parsing configuration file: {}\n{}'.format(self.ini_fn, e), file=sys.stderr)
             sys.exit(1)
 
-        try:
-            self._load_cache()
-        except Exception as e:
-            print('Error opening cache file: {}, {}'.format(self.html_cache_fn, e), file=sys.stderr)
+        with self._profile_phase('parse'):
+            try:
+                self._load_cache()
+            except Exception as e:
+                print('Error opening cache file: {}, {}'.format(self.html_cache_fn, e), file=sys.stderr)
 
-        try:
-            broadcasts_last_week = requests.get(CURRENT_URL).json()
-        except Exception as e:
-            print('Error loading current broadcasts: {}'.format(e), file=sys.stderr)
-            sys.exit(1)
+            try:
+                self._load_text_cache()
+            except Exception as e:
+                print('Error opening text cache: {}'.format(e), file=sys.stderr)
+
+            try:
+                self.state = StateStore(self.state_fn)
+            except Exception as e:
+                print('Error opening state database: {}, {}'.format(self.state_fn, e), file=sys.stderr)
+
+            try:
+                self.refresh()
+            except Exception as e:
+                print('Error loading current broadcasts: {}'.format(e), file=sys.stderr)
+                sys.exit(1)
+
+    def _profile_phase(self, phase):
+        """Profiles the block with --profile, next to the cache file"""
+        if not self.profile:
+            return contextlib.nullcontext()
+        return PhaseProfiler(os.path.join(os.path.dirname(self.html_cache_fn), PROFILE_FN.format(phase)),
+            cpu=self.profile in ('cpu', 'both'), mem=self.profile in ('mem', 'both'))
 
-        for broadcasts_for_day in broadcasts_last_week:
-            for single_broadcast in broadcasts_for_day['broadcasts']:
-                self.broadcasts_for_current_week.append(single_broadcast)
+    def refresh(self):
+        """Loads the schedule and the details of the broadcasts of interest
 
-        broadcasts_of_interest = []
-        for broadcast in self.broadcasts_for_current_week:
-            section = self._is_broadcast_of_interest(broadcast)
-            if section:
-                broadcasts_of_interest.append((section, broadcast))
+        The attributes are only replaced once everything is loaded, so they stay usable if it fails."""
+        broadcasts_for_current_week = []
+        with self.metrics.stage('schedule') as event:
+            for broadcasts_for_day in self._load_schedule():
+                for single_broadcast in broadcasts_for_day['broadcasts']:
+                    broadcasts_for_current_week.append(single_broadcast)
+            event['not_modified'] = self.schedule_not_modified
 
-        print('Parsing information for {} broadcasts:'.format(len(broadcasts_of_interest)))
-        for section, broadcast_of_interest in tqdm(broadcasts_of_interest, desc='   Parsing'):
+        with self.metrics.stage('match'):
+            schedule_of_interest = [
+                (section, broadcast)
+                for section, broadcast in zip(self._match_schedule(broadcasts_for_current_week),
+                    broadcasts_for_current_week)
+                if section]
+
+        print('Parsing information for {} broadcasts:'.format(len(schedule_of_interest)))
+        hrefs_to_fetch = []
+        # the metric labels of the detail fetches, like those of the job stages
+        fetch_labels = {}
+        for section, broadcast_of_interest in schedule_of_interest:
             href = broadcast_of_interest['href']
-            if not self.no_cache and href in self.broadcasts_data and 'message' not in self.broadcasts_data[href]:
-                data = self.broadcasts_data[href]
-            else:
-                try:
-                    data = requests.get(href).json()
-                    if 'message' in data:
-                        print('No data available for {}'.format(href), file=sys.stderr)
-                        continue
-                    self.broadcasts_data[href] = data
-                except Exception as e:
-                    print('Error loading info from {}: {}'.format(href, e), file=sys.stderr)
+            if not self._is_cached(href) and href not in fetch_labels:
+                hrefs_to_fetch.append(href)
+                fetch_labels[href] = {'section': section, 'broadcast': broadcast_of_interest.get('id')}
+        self.metrics.count('detail_cache_misses', len(hrefs_to_fetch))
+        self.metrics.count('detail_cache_hits', len(set(broadcast['href'] for _, broadcast in schedule_of_interest))
+            - len(hrefs_to_fetch))
+
+        if self.engine == 'async':
+            fetched = dict(zip(hrefs_to_fetch, asyncio.run(
+                self._fetch_all_broadcast_data_async(hrefs_to_fetch, fetch_labels))))
+        else:
+            # executor.map keeps the order of the hrefs, so the results are deterministic
+            fetched = {}
+            with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+                for href, data in zip(hrefs_to_fetch, tqdm(
+                        executor.map(lambda href: self._fetch_broadcast_data(href, **fetch_labels[href]),
+                            hrefs_to_fetch),
+                        total=len(hrefs_to_fetch),
+                        desc='   Parsing')):
+                    fetched[href] = data
+                    # stored right away, so an interrupted run keeps everything fetched so far
+                    if data is not None:
+                        self.broadcasts_data[href] = data
+
+        broadcasts_of_interest = defaultdict(list)
+        for section, broadcast_of_interest in schedule_of_interest:
+            href = broadcast_of_interest['href']
+            if href in fetched:
+                data = fetched[href]
+                if data is None:
                     continue
+            else:
+                data = self.broadcasts_data[href]
             if 'streams' in data and len(data['streams']):
-                self.broadcasts_of_interest[section].add(Broadcast(data))
+                broadcasts_of_interest[section].append(Broadcast(data, self.text_cache))
+
+        self.broadcasts_for_current_week = broadcasts_for_current_week
+        self.schedule_of_interest = schedule_of_interest
+        self.broadcasts_of_interest = broadcasts_of_interest
+
+    def _is_cached(self, href):
+        # details fetched before the broadcast was available have no streams yet and are fetched again
+        return not self.no_cache and href in self.broadcasts_data and 'message' not in self.broadcasts_data[href] \
+            and bool(self.broadcasts_data[href].get('streams'))
+
+    def _fetch_broadcast_data(self, href, **labels):
+        """Returns the JSON data of a single broadcast or None if it is not available
+
+        The labels, e.g. section and broadcast, are added to the metrics event of the request."""
+        try:
+            with self.metrics.stage('detail fetch', **labels) as event:
+                response = self.session.get(href, timeout=DOWNLOAD_TIMEOUT)
+                event['bytes'] = len(response.content)
+                data = response.json()
+                if 'message' in data:
+                    event['error'] = data['message']
+        except Exception as e:
+            print('Error loading info from {}: {}'.format(href, e), file=sys.stderr)
+            return None
+        if 'message' in data:
+            print('No data available for {}'.format(href), file=sys.stderr)
+            return None
+        return data
 
     def download_interesting(self):
+        with self._profile_phase('process'):
+            self._download_interesting()
+
+    def _download_interesting(self):
+        if self.schedule_not_modified and not self.dry_run and self._everything_on_disk():
+            print('Schedule not modified, nothing new.')
+            return
+        self._progress_positions = queue.Queue()
+        for position in range(1, self.encode_jobs + 1):
+            self._progress_positions.put(position)
+        self._stop.clear()
+        if self.engine == 'async':
+            asyncio.run(self._download_interesting_async())
+            return
+        # the stages run concurrently, so the downloads go on while the previous broadcasts are encoded
+        pipeline = Pipeline(self._pipeline_error, self.queue_size, self._stop)
+        pipeline.add_stage('download', self._download_stage, self.download_jobs)
+        pipeline.add_stage('encode', self._encode_job_stage, self.encode_jobs)
+        pipeline.add_stage('tag', self._tag_stage, self.tag_jobs)
+        pipeline.add_stage('cleanup', lambda item: self._cleanup(item.job))
+        pipeline.run(self._pipeline_jobs())
+
+    def _pipeline_jobs(self):
+        """Yields the jobs to process with their state action, see _state_action()"""
         for section, broadcasts in tqdm(self.broadcasts_of_interest.items(), unit='Broadcast', desc='Processing'):
             for broadcast in broadcasts:
                 try:
-                    metadata = {
-                        'SECTION': section,
-                        'DOWNLOAD_BASEDIR': self.download_basedir,
-                    }
-                    metadata.update(broadcast.metadata)
-
-                    target_dir = self.broadcasts_rules[section]['ini']['TargetDir'].format_map(metadata)
-                    ffmpeg_options = self.broadcasts_rules[section]['ini']['FFmpegArguments']
-                    target_fn = repl_unsave(
-                        self.broadcasts_rules[section]['ini']['TargetName'].format_map(metadata)).strip()
-                    if 'opus' in ffmpeg_options.lower():
-                        target_fn += '.opus'
-                    elif 'mp3' in ffmpeg_options.lower():
-                        target_fn += '.mp3'
-                    elif 'vorbis' in ffmpeg_options.lower():
-                        target_fn += '.ogg'
-                    elif 'aac' in ffmpeg_options.lower():
-                        target_fn += '.m4a'
-                    else:
-                        tqdm.write('Warning: no extension for output audio file {}'.format(target_fn))
-                    download_fn = os.path.normpath(os.path.join(target_dir, broadcast.download_filename))
-                    conversion_fn = os.path.normpath(os.path.join(target_dir, target_fn))
-                    if not self.dry_run:
-                        if not os.path.isdir(target_dir):
-                            os.makedirs(target_dir)
-                        # download media file
-                        if not os.path.isfile(download_fn) and (not os.path.isfile(conversion_fn) or self.reconvert):
-                            try:
-                                response = requests.get(broadcast.download_url, stream=True, timeout=3)
-                                total_size = int(response.headers.get('content-length', 0))
-                                chunk_size = 1024 * 1024
-                                with open(download_fn, 'wb') as fout:
-                                    for data in tqdm(
-                                            response.iter_content(chunk_size),
-                                            desc=broadcast.download_filename,
-                                            total=total_size // chunk_size,
-                                            leave=False,
-                                            unit='MB',
-                                            unit_scale=False):
-                                        fout.write(data)
-                            except:
-                                if os.path.isfile(download_fn):
-                                    os.remove(download_fn)
-                                raise
-
-                        newly_converted = False
-                        if not os.path.isfile(conversion_fn) or self.reconvert:
-                            if not os.path.isfile(download_fn):
-                                raise ValueError('File {} does not exist'.format(download_fn))
-                            if download_fn == conversion_fn:
-                                raise ValueError('Conversion: Same filename as input file')
-                            # convert media file
-                            tqdm.write('Encoding {}'.format(target_fn))
-                            encode_audiofile(download_fn, conversion_fn,
-                                ffmpeg_executable=self.ffmpeg,
-                                ffmpeg_options=ffmpeg_options,
-                                length=self._length if self._length > 0 else None)
-                            newly_converted = True
-                        # tag media file
-                        if newly_converted or self.retag:
-                            tag_dict = {}
-                            for key, value in self.broadcasts_rules[section]['ini'].items():
-                                if key.startswith('Tag'):
-                                    tag_name = key[3:].lower()
-                                    tag_dict[tag_name] = value.format_map(metadata)
-                            tag_media_file(conversion_fn, tag_dict)
-                        if self.broadcasts_rules[section]['ini']['KeepOriginal'].lower() == 'false':
-                            os.remove(download_fn)
+                    job = self._prepare_job(section, broadcast)
+                    if self.dry_run:
+                        continue
+                    action = self._state_action(job)
                 except Exception as e:
                     tqdm.write('Error {} {}'.format(broadcast, e))
                     continue
+                if action == 'skip':
+                    self.metrics.count('completed_broadcasts_skipped')
+                else:
+                    yield PipelineJob(job, action, False)
 
+    def _pipeline_error(self, item, e):
+        self.metrics.count('failed_broadcasts')
+        tqdm.write('Error {} {}'.format(item.job.broadcast, e))
 
-    def _is_broadcast_of_interest(self, broadcast):
-        """Returns the corresponding section if it is of interest"""
-        dt = datetime.datetime.fromtimestamp(int(broadcast['scheduledStart']) // 1000)
-        scheduled_time = dt.time()
-        weekday = dt.weekday()
-        for section, rule in self.broadcasts_rules.items():
+    def _download_stage(self, item):
+        if item.action == 'retag':
+            return item
+        return item._replace(newly_converted=self._download_job(item.job))
+
+    def _encode_job_stage(self, item):
+        if item.action is None and not item.newly_converted and self._needs_conversion(item.job):
+            if self._links_original(item.job):
+                self._link_original(item.job)
+            else:
+                self._encode_with_progress(item.job)
+            return item._replace(newly_converted=True)
+        return item
+
+    def _tag_stage(self, item):
+        """Tags and records the job, returns it for the cleanup unless only its tags had to be updated"""
+        job = item.job
+        if item.action == 'retag':
+            self._retag_job(job)
+            return None
+        tag_dict = None
+        if item.newly_converted or self.retag:
+            tag_dict = self._tag_dict(job)
+            if not self._tag_file(job, job.conversion_fn, tag_dict):
+                tag_dict = None
+        self._record_state(job, item.newly_converted, tag_dict)
+        return item
+
+    def _tag_file(self, job, media_fn, tag_dict):
+        """Tags the output file of a job, returns False and counts the broadcast as failed if that did not work"""
+        with self._job_stage('tag', job):
+            tagged = tag_media_file(media_fn, tag_dict)
+        if not tagged:
+            self.metrics.count('failed_broadcasts')
+        return tagged
+
+    def _everything_on_disk(self):
+        """True if no broadcast of interest needs to be converted or tagged"""
+        if self.retag or self.reconvert:
+            return False
+        try:
+            for section, broadcasts in self.broadcasts_of_interest.items():
+                for broadcast in broadcasts:
+                    job = self._prepare_job(section, broadcast)
+                    action = self._state_action(job)
+                    if action == 'retag' or action is None and not os.path.isfile(job.conversion_fn):
+                        return False
+            return True
+        except Exception:
+            return False
+
+    def _completed(self, job):
+        """Returns the state entry of a job if it has been converted with the current FFmpeg arguments"""
+        if self.state is None or self.reconvert:
+            return None
+        state = self.state.get(job.broadcast.loop_stream_id)
+        if state is not None and state['ffmpeg_args_hash'] == self._ffmpeg_args_hash(job):
+            return state
+        return None
+
+    def _state_action(self, job):
+        """Returns 'skip' or 'retag' if the state database knows the job's output, None if it has to be
+        processed (which still skips the files found on disk)"""
+        state = self._completed(job)
+        if state is None:
+            return None
+        if self.retag or state['tag_hash'] != self._tag_hash(self._tag_dict(job)):
+            # a recorded output file which has been removed since is processed like an unrecorded one
+            if not os.path.isfile(state['output_path']):
+                return None
+            return 'retag'
+        return 'skip'
+
+    def _ffmpeg_args_hash(self, job):
+        return digest(ffmpeg_command('', '', length=self._length if self._length > 0 else None,
+            ffmpeg_options=job.ffmpeg_options, ffmpeg_executable='')[1:])
+
+    @staticmethod
+    def _tag_hash(tag_dict):
+        return digest({tag_name: tag_value(value) for tag_name, value in tag_dict.items()})
+
+    def _record_state(self, job, converted, tag_dict=None):
+        """Records a finished job in the state database, if its file has been converted or tagged
+
+        tag_dict is None if the file has not been tagged successfully, so a converted file without tags is
+        tagged again by the next run."""
+        if self.state is None or not (converted or tag_dict is not None):
+            return
+        now = time.time()
+        values = {
+            'broadcast_id': job.broadcast.data['id'],
+            'section': job.section,
+            'output_path': os.path.abspath(job.conversion_fn),
+            'ffmpeg_args_hash': self._ffmpeg_args_hash(job),
+        }
+        if converted:
+            values['converted_at'] = now
+        if job.source:
+            values.update(job.source, downloaded_at=now)
+        if tag_dict is not None:
+            values.update(tag_hash=self._tag_hash(tag_dict), tagged_at=now)
+        self.state.record(job.broadcast.loop_stream_id, **values)
+
+    def _retag_job(self, job):
+        """Tags the recorded output file of a completed job again, runs in the tag stage or an executor thread"""
+        try:
+            tag_dict = self._tag_dict(job)
+            if self._tag_file(job, self.state.get(job.broadcast.loop_stream_id)['output_path'], tag_dict):
+                self.state.record(job.broadcast.loop_stream_id, tag_hash=self._tag_hash(tag_dict),
+                    tagged_at=time.time())
+        except Exception as e:
+            self.metrics.count('failed_broadcasts')
+            tqdm.write('Error {} {}'.format(job.broadcast, e))
+
+    def rebuild_state(self):
+        """Fills the state database from the tags of the media files below download_basedir
+
+        A file belongs to a broadcast of interest (of the schedule or the cache) if its title tag is the one
+        the broadcast's section writes, the tags are read in parallel."""
+        if self.state is None:
+            print('State database not available: {}'.format(self.state_fn), file=sys.stderr)
+            sys.exit(1)
+        broadcasts = {}
+        for section, section_broadcasts in self.broadcasts_of_interest.items():
+            for broadcast in section_broadcasts:
+                broadcasts[broadcast.loop_stream_id] = (section, broadcast)
+        for data in self.broadcasts_data.values():
+            if data.get('streams'):
+                section = self._is_broadcast_of_interest(data)
+                if section:
+                    broadcast = Broadcast(data, self.text_cache)
+                    broadcasts.setdefault(broadcast.loop_stream_id, (section, broadcast))
+
+        jobs_by_title = {}
+        tag_names = set()
+        for section, broadcast in broadcasts.values():
+            plan = self.broadcasts_rules[section]['plan']
+            if 'title' in plan.tags:
+                job = self._prepare_job(section, broadcast)
+                jobs_by_title[tag_value(plan.tags['title'](job.metadata))] = job
+                tag_names.update(plan.tags)
+
+        extensions = {extension for _, extension in OutputPlan.EXTENSIONS}
+        media_fns = [os.path.join(dirpath, fn)
+            for dirpath, _, fns in os.walk(self.download_basedir)
+            for fn in fns
+            if os.path.splitext(fn)[1].lower() in extensions]
+        found = 0
+        with ThreadPoolExecutor(max_workers=self.encode_jobs) as executor:
+            for media_fn, tags in zip(media_fns, tqdm(
+                    executor.map(functools.partial(read_tags, tag_names=tag_names), media_fns),
+                    total=len(media_fns), desc='  Scanning')):
+                job = jobs_by_title.get(tags.get('title'))
+                # a kept original linked to its output file has the same tags
+                if job is None or os.path.normpath(media_fn) == job.download_fn:
+                    continue
+                plan = self.broadcasts_rules[job.section]['plan']
+                self.state.record(job.broadcast.loop_stream_id,
+                    broadcast_id=job.broadcast.data['id'],
+                    section=job.section,
+                    output_path=os.path.abspath(media_fn),
+                    ffmpeg_args_hash=self._ffmpeg_args_hash(job),
+                    tag_hash=digest({tag_name: tags.get(tag_name) for tag_name in plan.tags}),
+                    converted_at=os.path.getmtime(media_fn))
+                found += 1
+        print('Recorded {} of {} media files for {} broadcasts of interest in {}'.format(
+            found, len(media_fns), len(broadcasts), self.state_fn))
+
+    def _prepare_job(self, section, broadcast):
+        """Renders the target names of a broadcast from the section's ini values"""
+        # a ChainMap keeps the broadcast's metadata lazy
+        metadata = collections.ChainMap({
+            'SECTION': section,
+            'DOWNLOAD_BASEDIR': self.download_basedir,
+        }, broadcast.metadata)
+
+        plan = self.broadcasts_rules[section]['plan']
+        target_dir = plan.target_dir(metadata)
+        target_fn = repl_unsave(plan.target_name(metadata)).strip() + plan.extension
+        return DownloadJob(
+            section=section,
+            broadcast=broadcast,
+            metadata=metadata,
+            target_dir=target_dir,
+            target_fn=target_fn,
+            download_fn=os.path.normpath(os.path.join(target_dir, broadcast.download_filename)),
+            conversion_fn=os.path.normpath(os.path.join(target_dir, target_fn)),
+            ffmpeg_options=plan.ffmpeg_args,
+            source={})
+
+    def _download_job(self, job):
+        """Downloads the media file of a job, returns True if it has been converted while downloading"""
+        if not os.path.isdir(job.target_dir):
+            os.makedirs(job.target_dir)
+        newly_converted = False
+        if self._can_stream(job):
+            self._stream_job(job)
+            newly_converted = True
+        elif self._needs_download(job):
+            self._download_media(job)
+        else:
+            self._hash_earlier_download(job)
+        return newly_converted
+
+    def _stream_job(self, job):
+        """Downloads and converts the media file of a job at once, the original is only written if it is kept"""
+        tqdm.write('Downloading and encoding {}'.format(job.target_fn))
+        with self._encode_slot() as position, self._encode_stage('download+encode', job) as event:
+            event.update(encode_stream(
+                hash_chunks(iter_download(self.session, job.broadcast.download_url,
+                    desc=job.broadcast.download_filename, stop=self._stop, position=position), job.source),
+                job.conversion_fn,
+                tee_fn=job.download_fn if self._keep_original(job) else None,
+                ffmpeg_executable=self.ffmpeg,
+                ffmpeg_options=job.ffmpeg_options,
+                length=self._length if self._length > 0 else None,
+                stop=self._stop))
+            event['bytes'] = job.source.get('download_size', 0)
+
+    def _download_media(self, job):
+        """Downloads the media file of a job, resuming and hashing it like any download"""
+        with self._job_stage('download', job) as event:
+            download_file(self.session, job.broadcast.download_url, job.download_fn,
+                desc=job.broadcast.download_filename, segments=self.download_segments, stop=self._stop,
+                source=job.source)
+            event['bytes'] = os.path.getsize(job.download_fn)
+
+    def _hash_earlier_download(self, job):
+        """Hashes the download of an earlier run for the state database if it is going to be converted
+
+        This runs in the download stage, the downloads of this run are hashed while they arrive."""
+        if not job.source and os.path.isfile(job.download_fn) and (
+                self.reconvert or not os.path.isfile(job.conversion_fn)):
+            job.source.update(file_source(job.download_fn))
+
+    def _job_stage(self, name, job, **labels):
+        return self.metrics.stage(name, section=job.section, broadcast=job.broadcast.data['id'], **labels)
+
+    def _encode_stage(self, name, job):
+        """A job stage running ffmpeg, labeled with the FFmpegArguments for the encode report"""
+        return self._job_stage(name, job, profile=' '.join(job.ffmpeg_options))
+
+    @contextlib.contextmanager
+    def _encode_slot(self):
+        """Takes one of the encode_jobs progress bar positions for running ffmpeg
+
+        The streamed encodes of the download stage take one as well, so the positions also bound the
+        concurrent ffmpeg processes to encode_jobs, like the encode semaphore of the async engine."""
+        position = self._progress_positions.get()
+        try:
+            yield position
+        finally:
+            self._progress_positions.put(position)
+
+    def _encode_with_progress(self, job):
+        """Runs ffmpeg for a job with its own progress bar in one of the pool's bar positions"""
+        length = self._length if self._length > 0 else None
+        total = job.broadcast.duration
+        if length is not None:
+            total = min(total, length) if total else length
+        tqdm.write('Encoding {}'.format(job.target_fn))
+        with self._encode_slot() as position:
+            bar_format = '{desc}: {percentage:3.0f}%|{bar}| {n:.0f}/{total_fmt}s' if total else '{desc}: {n:.0f}s'
+            with tqdm(desc=job.target_fn[:40], total=total, position=position, leave=False,
+                    bar_format=bar_format) as progress, self._encode_stage('encode', job) as event:
+                event.update(encode_audiofile(job.download_fn, job.conversion_fn,
+                    ffmpeg_executable=self.ffmpeg,
+                    ffmpeg_options=job.ffmpeg_options,
+                    length=length,
+                    progress=lambda seconds: progress.update(seconds - progress.n),
+                    stop=self._stop))
+                event['bytes'] = os.path.getsize(job.conversion_fn)
+
+    def _needs_download(self, job):
+        return not os.path.isfile(job.download_fn) and (not os.path.isfile(job.conversion_fn) or self.reconvert)
+
+    def _can_stream(self, job):
+        # a partial download is resumed instead of streamed from the beginning
+        return (self.stream_encode and self._needs_download(job) and job.download_fn != job.conversion_fn
+            and not self._links_original(job) and not os.path.isfile(job.download_fn + PART_SUFFIX))
+
+    def _needs_conversion(self, job):
+        if os.path.isfile(job.conversion_fn) and not self.reconvert:
+            return False
+        if not os.path.isfile(job.download_fn):
+            raise ValueError('File {} does not exist'.format(job.download_fn))
+        if job.download_fn == job.conversion_fn:
+            raise ValueError('Conversion: Same filename as input file')
+        return True
+
+    def _tag_dict(self, job):
+        return self.broadcasts_rules[job.section]['plan'].tag_dict(job.metadata)
+
+    def _keep_original(self, job):
+        return self.broadcasts_rules[job.section]['plan'].keep_original
+
+    def _links_original(self, job):
+        return self.broadcasts_rules[job.section]['plan'].mode == 'link'
+
+    def _link_original(self, job):
+        """Stores the original under the target name instead of encoding it, for FFmpegArguments = link
+
+        A kept original is hard linked, so it shares the tags of the output file; otherwise it is renamed."""
+        with self._job_stage('link', job) as event:
+            if os.path.isfile(job.conversion_fn):
+                os.remove(job.conversion_fn)
+            if not self._keep_original(job):
+                os.replace(job.download_fn, job.conversion_fn)
+            else:
+                try:
+                    os.link(job.download_fn, job.conversion_fn)
+                except OSError:
+                    # e.g. a file system without hard links
+                    shutil.copyfile(job.download_fn, job.conversion_fn + PART_SUFFIX)
+                    os.replace(job.conversion_fn + PART_SUFFIX, job.conversion_fn)
+            event['bytes'] = os.path.getsize(job.conversion_fn)
+
+    def _cleanup(self, job):
+        if not self._keep_original(job) and os.path.isfile(job.download_fn):
+            os.remove(job.download_fn)
+
+    async def _download_interesting_async(self):
+        """Processes all broadcasts as coroutines, bounded by a semaphore per stage like the sync pipeline
+
+        The blocking steps are the ones of the sync pipeline, run in executor threads. A cancellation, e.g. by a
+        KeyboardInterrupt, sets the stop event, so the threads stop and clean up before asyncio.run() returns."""
+        semaphores = {
+            'download': asyncio.Semaphore(self.download_jobs),
+            'encode': asyncio.Semaphore(self.encode_jobs),
+            'tag': asyncio.Semaphore(self.tag_jobs),
+            # the downloaded files on disk, being encoded or waiting for it
+            'scratch': asyncio.Semaphore(self.download_jobs + self.queue_size + self.encode_jobs),
+        }
+        # ffmpeg runs for a whole encode, in threads of its own which the encode semaphore bounds
+        with ThreadPoolExecutor(max_workers=self.encode_jobs, thread_name_prefix='ffmpeg') as ffmpeg_executor:
+            coroutines = [
+                self._process_broadcast_async(section, broadcast, semaphores, ffmpeg_executor)
+                for section, broadcasts in self.broadcasts_of_interest.items()
+                for broadcast in broadcasts]
             try:
-                if (rule['start_time'] <= scheduled_time <= rule['end_time']
-                        and weekday in rule['days']
-                        and rule['search_regexes']['title'].search(broadcast['title'])):
-                    return section
-            except Exception as e:
+                for coroutine in tqdm(asyncio.as_completed(coroutines), total=len(coroutines),
+                        unit='Broadcast', desc='Processing'):
+                    await coroutine
+            except BaseException:
+                self._stop.set()
+                raise
+
+    async def _process_broadcast_async(self, section, broadcast, semaphores, ffmpeg_executor):
+        loop = asyncio.get_running_loop()
+        try:
+            job = self._prepare_job(section, broadcast)
+            if self.dry_run:
+                return
+            action = self._state_action(job)
+            if action == 'skip':
+                self.metrics.count('completed_broadcasts_skipped')
+            elif action == 'retag':
+                async with semaphores['tag']:
+                    await loop.run_in_executor(None, self._retag_job, job)
+            if action is not None:
+                return
+            if not os.path.isdir(job.target_dir):
+                os.makedirs(job.target_dir)
+            newly_converted = False
+            if self._can_stream(job):
+                async with semaphores['download'], semaphores['encode']:
+                    await loop.run_in_executor(ffmpeg_executor, self._stream_job, job)
+                newly_converted = True
+            else:
+                async with semaphores['scratch']:
+                    if self._needs_download(job):
+                        async with semaphores['download']:
+                            await loop.run_in_executor(None, self._download_media, job)
+                    else:
+                        await loop.run_in_executor(None, self._hash_earlier_download, job)
+                    if self._needs_conversion(job):
+                        if self._links_original(job):
+                            await loop.run_in_executor(None, self._link_original, job)
+                        else:
+                            async with semaphores['encode']:
+                                await loop.run_in_executor(ffmpeg_executor, self._encode_with_progress, job)
+                        newly_converted = True
+            tag_dict = None
+            if newly_converted or self.retag:
+                tag_dict = self._tag_dict(job)
+                async with semaphores['tag']:
+                    if not await loop.run_in_executor(None, self._tag_file, job, job.conversion_fn, tag_dict):
+                        tag_dict = None
+            await loop.run_in_executor(None, self._record_state, job, newly_converted, tag_dict)
+            self._cleanup(job)
+        except Exception as e:
+            # the broadcasts stopped by an interruption haven't failed
+            if not self._stop.is_set():
+                self.metrics.count('failed_broadcasts')
                 tqdm.write('Error {} {}'.format(broadcast, e))
+
+    async def _fetch_all_broadcast_data_async(self, hrefs, labels):
+        """Fetches the JSON data of all hrefs concurrently, the results keep the order of hrefs
+
+        labels maps the hrefs to the metric labels of their requests."""
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.fetch_workers)
+        progress = tqdm(total=len(hrefs), desc='   Parsing')
+
+        async def fetch(href):
+            async with semaphore:
+                data = await loop.run_in_executor(None, functools.partial(self._fetch_broadcast_data, href,
+                    **labels[href]))
+            if data is not None:
+                self.broadcasts_data[href] = data
+            progress.update()
+            return data
+
+        try:
+            return await asyncio.gather(*(fetch(href) for href in hrefs))
+        finally:
+            progress.close()
+
+    def _match_schedule(self, broadcasts):
+        """Returns the section of interest of every broadcast, or an empty string"""
+        if len(broadcasts) >= SCHEDULE_TABLE_MIN_BROADCASTS and optional_import('numpy') is not None:
+            return ScheduleTable(broadcasts).match(self.broadcasts_rules)
+        return [self._is_broadcast_of_interest(broadcast) for broadcast in broadcasts]
+
+    def _is_broadcast_of_interest(self, broadcast):
+        """Returns the corresponding section if it is of interest"""
+        try:
+            dt = datetime.datetime.fromtimestamp(int(broadcast['scheduledStart']) // 1000)
+            return self.rule_index.match(
+                dt.weekday(), dt.hour * 3600 + dt.minute * 60 + dt.second, broadcast['title'])
+        except Exception as e:
+            tqdm.write('Error {} {}'.format(broadcast, e))
         return ''
 
     def _load_configuration(self):
-        config = configparser.ConfigParser(interpolation=None)
-        config.optionxform = str
+        self.broadcasts_rules = load_configuration(self.ini_fn)
+        self.rule_index = RuleIndex(self.broadcasts_rules)
+
+    def _load_schedule(self):
+        """Returns the broadcasts of the last week
+
+        The stored schedule is used without a request while it is younger than schedule_max_age,
+        otherwise it is revalidated with its ETag/Last-Modified values."""
+        self.schedule_not_modified = False
+        stored = None
+        if not self.no_cache and os.path.isfile(self.schedule_fn):
+            try:
+                with open(self.schedule_fn, 'r', encoding='utf-8') as fin:
+                    stored = json.load(fin)
+            except Exception as e:
+                print('Error opening schedule file: {}, {}'.format(self.schedule_fn, e), file=sys.stderr)
+        if stored is not None and stored.get('url') == CURRENT_URL:
+            if time.time() - stored['fetched_at'] < self.schedule_max_age:
+                self.schedule_not_modified = True
+                return stored['broadcasts']
+            headers = {}
+            if stored.get('etag'):
+                headers['If-None-Match'] = stored['etag']
+            if stored.get('last_modified'):
+                headers['If-Modified-Since'] = stored['last_modified']
+        else:
+            stored = None
+            headers = {}
+        response = self.session.get(CURRENT_URL, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 304 and stored is not None:
+            self.schedule_not_modified = True
+            stored['fetched_at'] = time.time()
+        else:
+            response.raise_for_status()
+            stored = {
+                'url': CURRENT_URL,
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+                'fetched_at': time.time(),
+                'broadcasts': response.json(),
+            }
         try:
-            with open(self.ini_fn, 'r', encoding='utf-8') as fin:
-                config.read_file(fin)
+            tmp_fn = self.schedule_fn + '.tmp'
+            with open(tmp_fn, 'w', encoding='utf-8') as fout:
+                json.dump(stored, fout, ensure_ascii=False)
+            os.replace(tmp_fn, self.schedule_fn)
         except Exception as e:
-            print('Unable to parse configuration file: {}\n{}'.format(self.ini_fn, e), file=sys.stderr)
-            sys.exit(1)
-        for section in config.sections():
-            self.broadcasts_rules[section] = {}
-            sr = self.broadcasts_rules[section]
-            sr['ini'] = INI_SECTION_DEFAULTS.copy()
-            sr['ini'].update({key: value for key, value in config[section].items()})
-            m = re.match(r'\s*(\d\d):(\d\d)\s*\-\s*(\d\d):(\d\d)\s*', sr['ini']['TimeWindow'])
-            sr['start_time'] = datetime.time(int(m.group(1)), int(m.group(2)))
-            sr['end_time'] = datetime.time(int(m.group(3)), int(m.group(4)))
-            sr['search_regexes'] = {
-                'title': re.compile(sr['ini']['title'], re.IGNORECASE)
-            }
-            sr['days'] = set(map(int, sr['ini']['Days'].split(',')))
+            print('Error writing schedule file: {}, {}'.format(self.schedule_fn, e), file=sys.stderr)
+        return stored['broadcasts']
 
     def _load_cache(self):
-        with bz2.BZ2File(self.html_cache_fn, 'rb') as fin:
-            self.broadcasts_data.update(json.loads(fin.read().decode('utf-8')))
+        # a bz2 cache file next to a new cache of another format is imported once
+        legacy_cache_fn = os.path.join(os.path.dirname(self.html_cache_fn), HTML_CACHE_FN)
+        if self.cache_backend == 'sqlite':
+            self.broadcasts_data = SqliteCache(self.html_cache_fn, migrate_from=legacy_cache_fn)
+            self.broadcasts_data.load()
+        elif not os.path.isfile(self.html_cache_fn) and os.path.isfile(legacy_cache_fn):
+            self.broadcasts_data.load(legacy_cache_fn)
+        else:
+            self.broadcasts_data.load()
+        evicted = self.broadcasts_data.evict(self.cache_max_age, self.cache_max_entries)
+        if evicted:
+            print('Evicted {} stale entries from the cache'.format(evicted))
 
-    def _write_cache(self):
-        if self.broadcasts_data:
-            with bz2.BZ2File(self.html_cache_fn, 'wb', compresslevel=9) as fout:
-                fout.write(json.dumps(self.broadcasts_data, indent=4, ensure_ascii=False).encode('utf-8'))
+    def _load_text_cache(self):
+        if self.cache_backend == 'sqlite':
+            self.text_cache = SqliteTextCache(self.broadcasts_data.db, self.cache_max_age, refresh=self.no_cache)
+        else:
+            self.text_cache = FileTextCache(self.html_cache_fn + TEXT_CACHE_SUFFIX, self.broadcasts_data.codec,
+                self.cache_max_age, refresh=self.no_cache)
 
-    def __del__(self):
+    def run_daemon(self):
+        """Processes the broadcasts of interest as they become available, until interrupted
+
+        Sleeps until shortly after the next broadcast of interest ends (at most DAEMON_MAX_SLEEP), and retries
+        with a growing delay while ended broadcasts are not available yet. Everything stays in memory between
+        the runs, only the schedule and the new details are fetched."""
+        retry_delay = 0
+        while True:
+            self.download_interesting()
+            self.checkpoint()
+            self.write_metrics()
+            now = time.time()
+            pending = self._pending_broadcasts(now)
+            if pending:
+                retry_delay = min(retry_delay * 2 or DAEMON_RETRY_DELAY, DAEMON_MAX_SLEEP)
+                wake_at = now + retry_delay
+                print('{} broadcasts are not available yet'.format(len(pending)))
+            else:
+                retry_delay = 0
+                wake_at = self._next_wake_time(now)
+            print('Next check at {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.fromtimestamp(wake_at)))
+            time.sleep(max(wake_at - time.time(), 0))
+            try:
+                with self._profile_phase('parse'):
+                    self.refresh()
+            except Exception as e:
+                print('Error loading current broadcasts: {}'.format(e), file=sys.stderr)
+
+    @staticmethod
+    def _scheduled_end(broadcast):
+        """The scheduled end of a schedule entry in seconds since the epoch, None if it is unknown"""
+        scheduled_end = broadcast.get('scheduledEnd', None)
+        return int(scheduled_end) / 1000 if scheduled_end else None
+
+    def _next_wake_time(self, now):
+        wake_at = now + DAEMON_MAX_SLEEP
+        for _, broadcast in self.schedule_of_interest:
+            scheduled_end = self._scheduled_end(broadcast)
+            if scheduled_end is not None and scheduled_end + DAEMON_END_DELAY > now:
+                wake_at = min(wake_at, scheduled_end + DAEMON_END_DELAY)
+        return wake_at
+
+    def _pending_broadcasts(self, now):
+        """Returns the hrefs of the broadcasts of interest which have recently ended but are not on disk"""
+        done = set()
+        for section, broadcasts in self.broadcasts_of_interest.items():
+            for broadcast in broadcasts:
+                try:
+                    job = self._prepare_job(section, broadcast)
+                except Exception:
+                    continue
+                if self._state_action(job) == 'skip' or os.path.isfile(job.conversion_fn):
+                    done.add(broadcast.data['href'])
+        pending = []
+        for _, broadcast in self.schedule_of_interest:
+            scheduled_end = self._scheduled_end(broadcast)
+            if scheduled_end is not None and now - DAEMON_RETRY_WINDOW < scheduled_end <= now \
+                    and broadcast['href'] not in done:
+                pending.append(broadcast['href'])
+        return pending
+
+    def checkpoint(self):
+        """Evicts stale cache entries and writes the caches, for long running processes"""
+        try:
+            self.broadcasts_data.evict(self.cache_max_age, self.cache_max_entries)
+            self.broadcasts_data.flush()
+            if self.text_cache is not None:
+                self.text_cache.flush()
+        except Exception as e:
+            print('Error writing cache file: {}'.format(e), file=sys.stderr)
+
+    def write_metrics(self):
+        """Writes the metrics collected since the last call to the metrics files, if any, and starts over"""
+        metrics, self.metrics = self.metrics, Metrics()
+        if self.text_cache is not None:
+            metrics.count('text_cache_hits', self.text_cache.hits)
+            metrics.count('text_cache_misses', self.text_cache.misses)
+            self.text_cache.hits = self.text_cache.misses = 0
+        try:
+            if self.metrics_fn:
+                metrics.write_json_lines(self.metrics_fn)
+            if self.prometheus_fn:
+                metrics.write_prometheus(self.prometheus_fn)
+        except Exception as e:
+            print('Error writing metrics: {}'.format(e), file=sys.stderr)
+
+    def close(self):
+        """Writes the outstanding cache data, fetched entries are already journaled while running"""
+        self.write_metrics()
         try:
-            self._write_cache()
+            if self.text_cache is not None:
+                self.text_cache.close()
+            self.broadcasts_data.close()
         except Exception as e:
             print('Error writing cache file: {}'.format(e), file=sys.stderr)
+        if self.state is not None:
+            self.state.close()
+
+
+def check_config(ini_fn):
+    """Prints the sections of an ini file, returns False if it is invalid"""
+    try:
+        broadcasts_rules = load_configuration(ini_fn)
+        RuleIndex(broadcasts_rules)
+    except Exception as e:
+        print('Error parsing configuration file: {}\n{}'.format(ini_fn, e), file=sys.stderr)
+        return False
+    for section, rule in broadcasts_rules.items():
+        print('[{}] {} on days {}, title /{}/ -> {}{}'.format(
+            section, rule['ini']['TimeWindow'], ','.join(map(str, sorted(rule['days']))), rule['ini']['title'],
+            rule['ini']['TargetName'], rule['plan'].extension))
+    print('{}: {} sections OK'.format(ini_fn, len(broadcasts_rules)))
+    return True
+
+
+def list_cached(ini_fn, cache_fn, cache_backend='file'):
+    """Prints the broadcasts in the cache with the section they belong to, without any network access
+
+    The cache is only read, a file cache whose entries are all in the journal included."""
+    if not os.path.isfile(cache_fn) and (cache_backend == 'sqlite' or not os.path.isfile(cache_fn + JOURNAL_SUFFIX)):
+        print('No cache file: {}'.format(cache_fn), file=sys.stderr)
+        return False
+    rule_index = RuleIndex(load_configuration(ini_fn))
+    cache = SqliteCache(cache_fn, read_only=True) if cache_backend == 'sqlite' else FileCache(cache_fn, read_only=True)
+    try:
+        cache.load()
+        entries = sorted(cache.values(), key=lambda data: int(data.get('scheduledStart') or 0))
+    finally:
+        cache.close()
+    for data in entries:
+        section = ''
+        scheduled_start = ''
+        if data.get('scheduledStart'):
+            dt = datetime.datetime.fromtimestamp(int(data['scheduledStart']) // 1000)
+            scheduled_start = '{:%Y-%m-%d %H:%M}'.format(dt)
+            section = rule_index.match(dt.weekday(), dt.hour * 3600 + dt.minute * 60 + dt.second,
+                data.get('title') or '')
+        print('{:16}  {:20}  {} (id:{}){}'.format(scheduled_start, section or '-', (data.get('title') or '').strip(),
+            data.get('id'), '' if data.get('streams') else ' [not available]'))
+    print('{} broadcasts in {}'.format(len(entries), cache_fn))
+    return True
 
 
 if __name__ == '__main__':
@@ -386,7 +2659,22 @@ if __name__ == '__main__':
         help='tag already existing target files again')
 
     parser.add_argument('--cache-file', default='',
-        help='the bz2 compressed json cache file (default: [download_basedir]/%s' % HTML_CACHE_FN)
+        help='the cache file or the SQLite cache database (default: [download_basedir]/%s with the '
+            'extension of the cache codec or [download_basedir]/%s)' % (CACHE_BASE_FN, SQLITE_CACHE_FN))
+
+    parser.add_argument('--cache-backend', choices=('file', 'sqlite'), default='file',
+        help='store the cache as one compressed file or in an SQLite database, an existing %s is '
+            'imported into a new database (default: %%(default)s)' % HTML_CACHE_FN)
+
+    parser.add_argument('--cache-codec', choices=tuple(CACHE_CODECS), default='json+bz2',
+        help='serialization and compression of the cache file, json+zstd, json+lz4 and msgpack+zstd need the '
+            'zstandard, lz4 or msgpack packages; any format is detected when loading (default: %(default)s)')
+
+    parser.add_argument('--cache-max-age', metavar='DURATION', type=parse_duration, default=CACHE_MAX_AGE,
+        help='remove cache entries of broadcasts older than this, e.g. 14d, 0 keeps them (default: 14d)')
+
+    parser.add_argument('--cache-max-entries', metavar='N', type=int, default=0,
+        help='keep at most N cache entries, 0 for no limit (default: %(default)s)')
 
     parser.add_argument('--length', metavar='SECONDS', type=int, default=0,
         help='just convert these first seconds (useful for debugging)')
@@ -394,13 +2682,99 @@ if __name__ == '__main__':
     parser.add_argument('--ffmpeg', metavar='FFMPEG_EXECUTABLE',
         default=FFMPEG_EXECUTABLE, help='ffmpeg executable (default: %(default)s)')
 
+    parser.add_argument('--fetch-workers', metavar='N', type=int, default=FETCH_WORKERS,
+        help='number of parallel connections for fetching broadcast details (default: %(default)s)')
+
+    parser.add_argument('--engine', choices=('sync', 'async'), default='sync',
+        help='run downloads and conversions as a pipeline of threads or as asyncio coroutines '
+            '(default: %(default)s)')
+
+    parser.add_argument('--download-jobs', metavar='N', type=int, default=DOWNLOAD_JOBS,
+        help='number of concurrent downloads (default: %(default)s)')
+
+    parser.add_argument('--encode-jobs', metavar='N', type=int, default=None,
+        help='number of concurrent ffmpeg processes (default: number of CPUs)')
+
+    parser.add_argument('--tag-jobs', metavar='N', type=int, default=TAG_JOBS,
+        help='number of files tagged at once (default: %(default)s)')
+
+    parser.add_argument('--queue-size', metavar='N', type=int, default=PIPELINE_QUEUE_SIZE,
+        help='number of broadcasts waiting in front of each stage, e.g. downloaded files waiting to be encoded '
+            '(default: %(default)s)')
+
+    parser.add_argument('--stream-encode', action='store_true',
+        help='pipe downloads directly into ffmpeg; the original is only written to disk if KeepOriginal is set')
+
+    parser.add_argument('--download-segments', metavar='N', type=int, default=1,
+        help='split each download into N parallel range requests (default: %(default)s)')
+
+    parser.add_argument('--schedule-max-age', metavar='DURATION', type=parse_duration, default=0,
+        help='reuse the stored schedule without asking the server while it is younger than this, '
+            'e.g. 600, 15m or 1h (default: always revalidate)')
+
+    parser.add_argument('--state-file', default='',
+        help='the SQLite database of completed broadcasts (default: [download_basedir]/%s)' % STATE_DB_FN)
+
+    parser.add_argument('--rebuild-state', action='store_true',
+        help='record the existing media files of the broadcasts of interest in the state database by their tags, '
+            'instead of downloading')
+
+    parser.add_argument('--daemon', action='store_true',
+        help='keep running and process the broadcasts of interest shortly after they have ended')
+
+    parser.add_argument('--check-config', action='store_true',
+        help='check the ini file and print its sections, without downloading anything')
+
+    parser.add_argument('--list-cached', action='store_true',
+        help='list the broadcasts in the cache with their sections, without downloading anything')
+
+    parser.add_argument('--metrics-file', default='',
+        help='append the duration, size and result of every stage and a summary of the run as JSON lines')
+
+    parser.add_argument('--prometheus-file', default='',
+        help='write the stage totals and counters of the last run for the Prometheus node exporter '
+            'textfile collector, e.g. /var/lib/node_exporter/oe1_get.prom')
+
+    parser.add_argument('--profile', choices=('cpu', 'mem', 'both'),
+        help='profile the parsing and the processing phase with cProfile and/or tracemalloc, written next to '
+            'the cache file as %s.pstats and .tracemalloc.txt' % PROFILE_FN.format('[phase]'))
+
     ARGS = parser.parse_args()
+    options = vars(ARGS).copy()
+    rebuild_state = options.pop('rebuild_state')
+    daemon = options.pop('daemon')
+
+    # these don't need the network and tagging modules, which are only imported when they are used
+    if options.pop('check_config'):
+        sys.exit(0 if check_config(ARGS.ini_file) else 1)
+    if options.pop('list_cached'):
+        sys.exit(0 if list_cached(ARGS.ini_file, ARGS.cache_file or default_cache_file(
+            ARGS.download_basedir, ARGS.cache_backend, ARGS.cache_codec), ARGS.cache_backend) else 1)
+
+    missing_module = cache_codec_missing(ARGS.cache_codec)
+    if missing_module:
+        print('Cache codec {} is not available, please install {}'.format(ARGS.cache_codec, missing_module),
+            file=sys.stderr)
+        sys.exit(1)
 
     if shutil.which(ARGS.ffmpeg) is None:
         print('FFmpeg executable not found: {}'.format(ARGS.ffmpeg), file=sys.stderr)
         sys.exit(1)
 
-    broadcast_downloader = BroadcastsDownloader(**vars(ARGS))
-    broadcast_downloader.download_interesting()
+    broadcast_downloader = BroadcastsDownloader(**options)
+    try:
+        if rebuild_state:
+            broadcast_downloader.rebuild_state()
+        elif daemon:
+            # a regular shutdown, so the caches are written
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                broadcast_downloader.run_daemon()
+            except KeyboardInterrupt:
+                pass
+        else:
+            broadcast_downloader.download_interesting()
+    finally:
+        broadcast_downloader.close()
     if ARGS.dry_run:
         print('This was a dry run.')